@@ -1,5 +1,5 @@
 from sphinxcontrib.imagehelper.imageext import (
-    image_node, ImageConverter, add_image_type
+    image_node, ImageConverter, add_image_type, setup
 )
 from sphinxcontrib.imagehelper.directives import (
     generate_image_directive, add_image_directive,
@@ -10,5 +10,5 @@ from sphinxcontrib.imagehelper.directives import (
 __all__ = [
     'image_node', 'ImageConverter', 'add_image_type',
     'generate_image_directive', 'add_image_directive',
-    'generate_figure_directive', 'add_figure_directive'
+    'generate_figure_directive', 'add_figure_directive', 'setup'
 ]
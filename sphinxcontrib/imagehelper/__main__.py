@@ -0,0 +1,4 @@
+import sys
+from sphinxcontrib.imagehelper.preconvert import main
+
+sys.exit(main())
@@ -0,0 +1,60 @@
+import os
+import time
+import threading
+from sphinxcontrib.imagehelper.metrics import get_cpu_time
+
+try:
+    import asyncio
+    TimeoutError = asyncio.TimeoutError
+except ImportError:  # Python 2.x
+    asyncio = None
+    TimeoutError = None
+
+
+def run_coroutines(calls, concurrency=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)  # attach child watcher for subprocesses (Python 3.7 and older)
+    queue = list(calls)
+    running = {}
+    finished = {}
+    outcomes = {}
+    cpu_started = get_cpu_time()
+
+    def on_done(task):
+        finished[task] = time.time()
+
+    try:
+        while queue or running:
+            while queue and (not concurrency or len(running) < concurrency):
+                key, func, args, timeout = queue.pop(0)
+                task = loop.create_task(asyncio.wait_for(func(*args), timeout))
+                task.add_done_callback(on_done)
+                running[task] = (key, time.time())
+
+            done, _ = loop.run_until_complete(asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                key, started = running.pop(task)
+                timing = {'started': started,
+                          'wall': finished[task] - started,
+                          'pid': os.getpid(),
+                          'tid': threading.current_thread().ident}
+                if task.exception():
+                    outcomes[key] = (None, task.exception(), timing)
+                else:
+                    outcomes[key] = (task.result(), None, timing)
+    except BaseException:
+        # cancel running conversions on interruption (e.g. Ctrl-C)
+        for task in running:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*running, return_exceptions=True))
+        raise
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    # the event loop runs conversions at the same time; share CPU time between them
+    cpu = (get_cpu_time() - cpu_started) / max(len(outcomes), 1)
+    for _, _, timing in outcomes.values():
+        timing['cpu'] = cpu
+
+    return outcomes
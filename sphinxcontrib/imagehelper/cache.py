@@ -0,0 +1,279 @@
+import os
+import time
+import filecmp
+import hashlib
+import threading
+from shutil import copyfile
+from sphinx.util.osutil import ensuredir
+from sphinxcontrib.imagehelper.utils import get_temporary_path, replace
+
+try:
+    import sqlite3
+except ImportError:  # Python built without SQLite
+    sqlite3 = None
+
+BUFSIZE = 64 * 1024
+SQLITE_TIMEOUT = 30
+
+
+def get_options_for(converter, node):
+    return [(name, node[name]) for name in sorted(converter.option_spec) if name in node]
+
+
+def get_converter_name(converter):
+    cls = converter.__class__
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def get_config_fingerprint(config, handler):
+    hashed = hashlib.sha1()
+    for name in sorted(handler.config_keys):
+        hashed.update(('%s=%r' % (name, getattr(config, name, None))).encode('utf-8'))
+
+    return hashed.hexdigest()
+
+
+class CacheBackend(object):
+    # key/value store of converted images; subclass it to share the cache via remote storage
+    def __init__(self, cachedir=None, max_size=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+
+    def get_key(self, converter, node, filename, to, args=()):
+        if not os.path.isfile(filename):
+            return None
+
+        hashed = hashlib.sha1()
+        hashed.update(get_converter_name(converter).encode('utf-8'))
+        hashed.update(str(converter.version).encode('utf-8'))
+        hashed.update(os.path.splitext(to)[1].encode('utf-8'))
+        for name, value in get_options_for(converter, node):
+            hashed.update(('%s=%r' % (name, value)).encode('utf-8'))
+
+        hashed.update(converter.get_config_fingerprint().encode('utf-8'))
+        if args:
+            hashed.update(('args=%r' % (args,)).encode('utf-8'))
+        self.update_hash(hashed, filename)
+        for path in converter.get_dependencies_for(node):
+            hashed.update(path.encode('utf-8'))
+            self.update_hash(hashed, os.path.join(converter.app.srcdir, path))
+
+        return hashed.hexdigest() + os.path.splitext(to)[1]
+
+    def update_hash(self, hashed, filename):
+        if not os.path.isfile(filename):
+            return
+
+        with open(filename, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(BUFSIZE), b''):
+                hashed.update(chunk)
+
+    def load(self, key):
+        raise NotImplementedError
+
+    def save(self, key, data):
+        raise NotImplementedError
+
+    def contains(self, key):
+        return self.load(key) is not None
+
+    def restore(self, key, to):
+        data = self.load(key)
+        if data is None:
+            return False
+
+        if os.path.exists(to):
+            with open(to, 'rb') as fd:
+                if fd.read() == data:
+                    return True
+
+        ensuredir(os.path.dirname(to))
+        tmppath = get_temporary_path(to)
+        with open(tmppath, 'wb') as fd:
+            fd.write(data)
+        replace(tmppath, to)
+        return True
+
+    def store(self, key, filename):
+        if not os.path.exists(filename):
+            return
+
+        with open(filename, 'rb') as fd:
+            self.save(key, fd.read())
+
+    def evict(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ConversionCache(CacheBackend):
+    def get_path(self, key):
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def load(self, key):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'rb') as fd:
+            return fd.read()
+
+    def save(self, key, data):
+        path = self.get_path(key)
+        ensuredir(os.path.dirname(path))
+        tmppath = get_temporary_path(path)
+        with open(tmppath, 'wb') as fd:
+            fd.write(data)
+        replace(tmppath, path)
+
+    def contains(self, key):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return False
+
+        os.utime(path, None)  # mark as recently used
+        return True
+
+    def restore(self, key, to):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return False
+
+        os.utime(path, None)  # mark as recently used
+        if not os.path.exists(to) or not filecmp.cmp(path, to, shallow=False):
+            ensuredir(os.path.dirname(to))
+            tmppath = get_temporary_path(to)
+            copyfile(path, tmppath)
+            replace(tmppath, to)
+        return True
+
+    def store(self, key, filename):
+        if not os.path.exists(filename):
+            return
+
+        path = self.get_path(key)
+        ensuredir(os.path.dirname(path))
+        tmppath = get_temporary_path(path)
+        copyfile(filename, tmppath)
+        replace(tmppath, path)
+
+    def entries(self):
+        for dirpath, _, filenames in os.walk(self.cachedir):
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    path = os.path.join(dirpath, filename)
+                    yield os.stat(path), path
+
+    def evict(self):
+        if not self.max_size or not os.path.isdir(self.cachedir):
+            return
+
+        entries = sorted(self.entries(), key=lambda entry: entry[0].st_mtime)
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if total <= self.max_size:
+                break
+
+            os.remove(path)
+            total -= stat.st_size
+
+
+class SQLiteCache(CacheBackend):
+    # single-file store; readers run concurrently with a writer in WAL mode
+    def __init__(self, cachedir, max_size=None):
+        super(SQLiteCache, self).__init__(cachedir, max_size)
+        self.path = os.path.join(cachedir, 'cache.sqlite')
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            ensuredir(self.cachedir)
+            conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS images '
+                         '(key TEXT PRIMARY KEY, data BLOB, size INTEGER, accessed REAL)')
+            conn.commit()
+            self.local.conn = conn  # one connection per thread; closed by close() in any thread
+            with self.lock:
+                self.connections.append(conn)
+
+        return conn
+
+    def load(self, key):
+        conn = self.connect()
+        row = conn.execute('SELECT data FROM images WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        with conn:  # mark as recently used
+            conn.execute('UPDATE images SET accessed = ? WHERE key = ?', (time.time(), key))
+        return bytes(row[0])
+
+    def save(self, key, data):
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)',
+                         (key, sqlite3.Binary(data), len(data), time.time()))
+
+    def evict(self):
+        if not self.max_size or not os.path.exists(self.path):
+            return
+
+        with self.connect() as conn:
+            total = 0
+            for key, size in conn.execute('SELECT key, size FROM images ORDER BY accessed DESC').fetchall():
+                total += size
+                if total > self.max_size:
+                    conn.execute('DELETE FROM images WHERE key = ?', (key,))
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+
+BACKENDS = {
+    'directory': ConversionCache,
+    'sqlite': SQLiteCache,
+}
+
+
+def get_cache(app):
+    cachedir = app.config.imagehelper_cache_dir
+    backend = app.config.imagehelper_cache_backend or 'directory'
+    if not cachedir and not callable(backend):
+        return None
+
+    cache = getattr(app, 'imageext_cache', None)
+    if cache is None:
+        if callable(backend):
+            cls = backend
+        elif backend not in BACKENDS:
+            app.warn('Unknown imagehelper_cache_backend: %s (use directory)' % backend)
+            cls = ConversionCache
+        elif backend == 'sqlite' and sqlite3 is None:
+            app.warn('sqlite3 module is not available (use directory)')
+            cls = ConversionCache
+        else:
+            cls = BACKENDS[backend]
+
+        if cachedir:
+            cachedir = os.path.join(app.confdir or app.srcdir, cachedir)
+        cache = cls(cachedir, app.config.imagehelper_cache_size)
+        app.imageext_cache = cache
+
+    return cache
+
+
+def cleanup_cache(app):
+    cache = getattr(app, 'imageext_cache', None)
+    if cache is not None:
+        cache.evict()
+        cache.close()
+        app.imageext_cache = None
@@ -0,0 +1,54 @@
+import struct
+
+try:
+    import imagesize
+except ImportError:  # Sphinx (< 1.4)
+    imagesize = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def read_image_size(path):
+    try:
+        with open(path, 'rb') as fd:
+            header = fd.read(24)
+    except (IOError, OSError):
+        return None
+
+    if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+        return struct.unpack('>II', header[16:24])
+    elif header[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', header[6:10])
+    elif Image is not None:
+        try:
+            return Image.open(path).size
+        except (IOError, OSError):
+            return None
+    else:
+        return None
+
+
+def get_image_dimensions(path):
+    # returns (width, height, dpi); dpi is a tuple of (x, y) or None
+    size = dpi = None
+    if imagesize:
+        try:
+            width, height = imagesize.get(path)
+            if width > 0 and height > 0:
+                size = (int(round(width)), int(round(height)))
+            if hasattr(imagesize, 'getDPI'):  # imagesize 1.0+
+                xdpi, ydpi = imagesize.getDPI(path)
+                if xdpi > 0 and ydpi > 0:
+                    dpi = (xdpi, ydpi)
+        except (IOError, OSError, ValueError):
+            pass
+
+    if size is None:
+        size = read_image_size(path)
+    if size is None:
+        return None
+    else:
+        return (size[0], size[1], dpi)
@@ -4,6 +4,8 @@ import posixpath
 from docutils import nodes
 from docutils.parsers.rst.directives.images import Image, Figure
 from sphinxcontrib.imagehelper import image_node
+from sphinxcontrib.imagehelper.statcache import get_stat_cache
+from sphinxcontrib.imagehelper.tracing import get_tracer
 
 URI_PATTERN = re.compile('^\w+://')
 
@@ -16,6 +18,11 @@ class ImageExtMixIn(object):
         pass
 
     def run(self):
+        env = self.state.document.settings.env
+        with get_tracer(getattr(env, 'app', None)).span('directive', docname=env.docname, uri=self.arguments[0]):
+            return self.process()
+
+    def process(self):
         name = self.options.pop('name', None)
         result = super(ImageExtMixIn, self).run()
         self.prerun()
@@ -26,7 +33,8 @@ class ImageExtMixIn(object):
         else:
             dirname = os.path.dirname(env.doc2path(env.docname, base=None))
             relpath = posixpath.join(dirname, self.arguments[0])
-            if not os.access(os.path.join(env.srcdir, relpath), os.R_OK):
+            statcache = get_stat_cache(getattr(env, 'app', None))
+            if not statcache.is_readable(os.path.join(env.srcdir, relpath)):
                 raise self.warning('%s file not readable: %s' % (self.imageext_type, self.arguments[0]))
             env.note_dependency(relpath)
 
@@ -0,0 +1,248 @@
+import os
+import json
+import hashlib
+import posixpath
+import threading
+from multiprocessing.pool import ThreadPool
+from email.utils import parsedate_tz, mktime_tz
+from sphinx.util.osutil import ensuredir
+from sphinxcontrib.imagehelper.utils import get_temporary_path, replace
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urljoin, urlsplit
+except ImportError:  # Python 2.x
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urljoin, urlsplit
+
+SCHEMES = ('http', 'https')
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+USER_AGENT = 'sphinxcontrib-imagehelper'
+
+
+class FetchError(Exception):
+    pass
+
+
+def is_fetchable(converter, uri):
+    return bool(converter.fetch_remote_images) and urlsplit(uri).scheme in SCHEMES
+
+
+def parse_http_date(value):
+    parsed = parsedate_tz(value or '')
+    if parsed is None:
+        return None
+    else:
+        return mktime_tz(parsed)
+
+
+class ConnectionPool(object):
+    def __init__(self, maxsize=4, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle = {}
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, scheme, netloc):
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+            self.opened += 1
+
+        if scheme == 'https':
+            return HTTPSConnection(netloc, timeout=self.timeout), False
+        else:
+            return HTTPConnection(netloc, timeout=self.timeout), False
+
+    def release(self, scheme, netloc, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def request(self, url, headers):
+        scheme, netloc, path, query, _ = urlsplit(url)
+        if scheme not in SCHEMES:
+            raise FetchError('Unsupported URL: %s' % url)
+
+        target = path or '/'
+        if query:
+            target += '?' + query
+
+        while True:
+            conn, reused = self.acquire(scheme, netloc)
+            try:
+                conn.request('GET', target, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (HTTPException, IOError, OSError) as exc:
+                conn.close()
+                if reused:
+                    continue  # the server has closed the idle connection; retry with new one
+                raise FetchError('Fail to fetch %s: %s' % (url, exc))
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(scheme, netloc, conn)
+            return response, body
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+class RemoteFetcher(object):
+    def __init__(self, cachedir, connections=4, timeout=None, warn=None):
+        self.cachedir = cachedir
+        self.connections = connections or 1
+        self.pool = ConnectionPool(self.connections, timeout)
+        self.threads = None
+        self.warn = warn or (lambda message: None)
+        self.fetched = {}
+        self.lock = threading.Lock()
+        self.downloads = 0
+        self.not_modified = 0
+        self.failures = 0
+        self.bytes_downloaded = 0
+
+    def get_path(self, url):
+        ext = posixpath.splitext(urlsplit(url).path)[1]
+        if not ext[1:].isalnum():
+            ext = ''
+        return os.path.join(self.cachedir, hashlib.sha1(url.encode('utf-8')).hexdigest() + ext)
+
+    def get_meta_path(self, url):
+        return os.path.splitext(self.get_path(url))[0] + '.headers.json'
+
+    def load_meta(self, url):
+        try:
+            with open(self.get_meta_path(url)) as fd:
+                return json.load(fd)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_meta(self, url, meta):
+        path = self.get_meta_path(url)
+        tmppath = get_temporary_path(path)
+        with open(tmppath, 'w') as fd:
+            json.dump(meta, fd)
+        replace(tmppath, path)
+
+    def count(self, name, value=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def fetch(self, url):
+        if url not in self.fetched:
+            path = self.get_path(url)
+            try:
+                self.download(url, path)
+            except FetchError as exc:
+                self.count('failures')
+                if os.path.exists(path):
+                    self.warn('%s (use cached copy)' % exc)
+                else:
+                    self.warn(str(exc))
+                    path = None
+            self.fetched[url] = path
+
+        return self.fetched[url]
+
+    def fetch_many(self, urls):
+        urls = sorted(set(url for url in urls if url not in self.fetched))
+        if len(urls) > 1 and self.connections > 1:
+            if self.threads is None:
+                self.threads = ThreadPool(self.connections)
+            self.threads.map(self.fetch, urls)
+        else:
+            for url in urls:
+                self.fetch(url)
+
+        return dict((url, self.fetched[url]) for url in urls)
+
+    def download(self, url, path):
+        headers = {'User-Agent': USER_AGENT}
+        meta = self.load_meta(url) if os.path.exists(path) else {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        location = url
+        for _ in range(MAX_REDIRECTS + 1):
+            response, body = self.pool.request(location, headers)
+            if response.status in REDIRECTS and response.getheader('location'):
+                location = urljoin(location, response.getheader('location'))
+            else:
+                break
+        else:
+            raise FetchError('Fail to fetch %s: too many redirects' % url)
+
+        if response.status == 304:
+            self.count('not_modified')
+            return
+        elif response.status != 200:
+            raise FetchError('Fail to fetch %s: %d %s' % (url, response.status, response.reason))
+
+        self.store(path, body, parse_http_date(response.getheader('last-modified')))
+        self.save_meta(url, {'url': url,
+                             'etag': response.getheader('etag'),
+                             'last_modified': response.getheader('last-modified')})
+        self.count('downloads')
+        self.count('bytes_downloaded', len(body))
+
+    def store(self, path, body, last_modified):
+        ensuredir(os.path.dirname(path))
+        if os.path.exists(path):
+            with open(path, 'rb') as fd:
+                unchanged = (fd.read() == body)
+        else:
+            unchanged = False
+
+        if not unchanged:  # keep the timestamp of unchanged source to skip conversion
+            tmppath = get_temporary_path(path)
+            with open(tmppath, 'wb') as fd:
+                fd.write(body)
+            replace(tmppath, path)
+
+        if last_modified is not None:
+            os.utime(path, (last_modified, last_modified))
+
+    def close(self):
+        if self.threads is not None:
+            self.threads.close()
+            self.threads.join()
+            self.threads = None
+        self.pool.close()
+
+
+def get_fetcher(app):
+    fetcher = getattr(app, 'imageext_fetcher', None)
+    if fetcher is None:
+        cachedir = os.path.join(app.doctreedir, 'imagehelper_remote')
+        fetcher = RemoteFetcher(cachedir,
+                                app.config.imagehelper_fetch_connections,
+                                app.config.imagehelper_fetch_timeout,
+                                app.warn)
+        app.imageext_fetcher = fetcher
+
+    return fetcher
+
+
+def release_fetcher(app):
+    fetcher = getattr(app, 'imageext_fetcher', None)
+    app.imageext_fetcher = None
+    if fetcher is not None:
+        fetcher.close()
+    return fetcher
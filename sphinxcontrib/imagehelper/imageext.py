@@ -1,58 +1,204 @@
 import os
 import re
-import cgi
 import posixpath
 from math import ceil
+import sphinx
 from docutils import nodes
-from sphinx.util.osutil import ensuredir
+from sphinx import addnodes
 from docutils.parsers.rst import directives
 from docutils.parsers.rst.directives.images import Image, Figure
-from sphinxcontrib.imagehelper.utils import get_imagedir
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+from sphinxcontrib.imagehelper.utils import get_imagedir, get_mimetype
+from sphinxcontrib.imagehelper.cache import (
+    cleanup_cache, get_config_fingerprint, get_converter_name, get_options_for
+)
+from sphinxcontrib.imagehelper.fetch import get_fetcher, is_fetchable, release_fetcher
+from sphinxcontrib.imagehelper.limits import run_command
+from sphinxcontrib.imagehelper.manifest import get_manifest, load_manifest, save_manifest
+from sphinxcontrib.imagehelper.metrics import get_metrics, report_metrics
+from sphinxcontrib.imagehelper.srcset import add_srcset, scale_image
+from sphinxcontrib.imagehelper.statcache import get_stat_cache, release_stat_cache
+from sphinxcontrib.imagehelper.translator import depart_image, visit_image
+from sphinxcontrib.imagehelper.tracing import get_tracer, init_tracer, save_tracer
+from sphinxcontrib.imagehelper.worker import WorkerError, get_worker_group, shutdown_workers
+from sphinxcontrib.imagehelper.scheduler import ConversionJob, get_scheduler, shutdown_scheduler
 
 URI_PATTERN = re.compile('^\w+://')
+PARSED_OPTIONS = {}
 
 
 class image_node(nodes.General, nodes.Element):
     pass
 
 
-def get_imageext_handler(app, uri):
-    ext = os.path.splitext(uri.lower())[1][1:]
-    if ext in app.imageext_types:
-        _, handler = app.imageext_types[ext]
-        return handler
-    else:
-        for pattern in app.imageext_url_patterns:
-            if uri.startswith(pattern):
-                _, handler = app.imageext_url_patterns[pattern]
-                return handler
+class ImageTypeRegistry(object):
+    def __init__(self):
+        self.types = {}
+        self.url_patterns = {}
+        self.handlers = {}
+        self.url_matcher = None
+
+    def add(self, name, ext, handler):
+        if URI_PATTERN.match(ext):
+            self.url_patterns[ext] = (name, handler)
         else:
-            return None
+            if ext.startswith('.'):
+                ext = ext[1:]
 
+            self.types[ext] = (name, handler)
 
-def get_imageext_handler_by_name(app, imageext_type):
-    for name, handler in app.imageext_types.values():
-        if name == imageext_type:
-            return handler
-    else:
-        for name, handler in app.imageext_url_patterns.values():
-            if name == imageext_type:
-                return handler
+        self.rebuild()
+
+    def rebuild(self):
+        self.handlers = {}
+        for name, handler in list(self.types.values()) + list(self.url_patterns.values()):
+            self.handlers.setdefault(name, handler)
+
+        # longer patterns first; the first matched alternative is the longest prefix
+        patterns = sorted(self.url_patterns, key=lambda pattern: (-len(pattern), pattern))
+        if patterns:
+            self.url_matcher = re.compile('|'.join(re.escape(pattern) for pattern in patterns))
+        else:
+            self.url_matcher = None
+
+    def get_handler(self, uri):
+        ext = os.path.splitext(uri.lower())[1][1:]
+        if ext in self.types:
+            return self.types[ext][1]
+        elif self.url_matcher:
+            matched = self.url_matcher.match(uri)
+            if matched:
+                return self.url_patterns[matched.group(0)][1]
 
         return None
 
+    def get_handler_by_name(self, name):
+        return self.handlers.get(name)
+
+
+def get_imageext_handler(app, uri):
+    return app.imageext_registry.get_handler(uri)
+
+
+def get_imageext_handler_by_name(app, imageext_type):
+    return app.imageext_registry.get_handler_by_name(imageext_type)
+
+
+def note_image(app, image, handler):
+    env = app.env
+    if not hasattr(env, 'imagehelper_images'):
+        env.imagehelper_images = {}
+    if not hasattr(env, 'imagehelper_converters'):
+        env.imagehelper_converters = {}
+
+    if not hasattr(env, 'imagehelper_read_images'):
+        env.imagehelper_read_images = {}
+
+    env.imagehelper_images.setdefault(env.docname, set()).add(image['uri'])
+    if handler:
+        converter = get_scheduler(app).get_converter(handler)
+        env.imagehelper_converters.setdefault(env.docname, set()).add(get_converter_name(converter))
+        for path in converter.get_dependencies_for(image):
+            env.note_dependency(path)
+
+        # converted from env-updated, before the documents are resolved
+        copied = image.deepcopy()
+        copied.document = None
+        env.imagehelper_read_images.setdefault(env.docname, []).append(copied)
+
+
+def on_env_purge_doc(app, env, docname):
+    if hasattr(env, 'imagehelper_images'):
+        env.imagehelper_images.pop(docname, None)
+    if hasattr(env, 'imagehelper_converters'):
+        env.imagehelper_converters.pop(docname, None)
+    if hasattr(env, 'imagehelper_read_images'):
+        env.imagehelper_read_images.pop(docname, None)
+    get_manifest(env).purge_doc(docname)
+
+
+def on_env_merge_info(app, env, docnames, other):
+    for attr in ('imagehelper_images', 'imagehelper_converters', 'imagehelper_read_images'):
+        if not hasattr(env, attr):
+            setattr(env, attr, {})
+
+        values = getattr(other, attr, {})
+        for docname in docnames:
+            if docname in values:
+                getattr(env, attr)[docname] = values[docname]
+
+    tracer = get_tracer(app)
+    if tracer.enabled:
+        tracer.events.extend(getattr(other, 'imagehelper_trace_events', []))
+
+
+def on_env_get_outdated(app, env, added, changed, removed):
+    env = app.env  # some versions of Sphinx pass the builder object instead of env
+    fingerprints = {}
+    for handler in set(app.imageext_registry.handlers.values()):
+        if handler.config_keys:
+            name = '%s.%s' % (handler.__module__, handler.__name__)
+            fingerprints[name] = get_config_fingerprint(app.config, handler)
+
+    # rebuild documents using the handlers whose config values have been changed
+    previous = getattr(env, 'imagehelper_config_fingerprints', {})
+    modified = set(name for name in fingerprints if name in previous and previous[name] != fingerprints[name])
+    env.imagehelper_config_fingerprints = fingerprints
+
+    converters = getattr(env, 'imagehelper_converters', {})
+    return [docname for docname in converters
+            if converters[docname] & modified and docname not in removed]
+
 
 def on_builder_inited(app):
     Image.option_spec['option'] = directives.unchanged
     Figure.option_spec['option'] = directives.unchanged
+    load_manifest(app).verify(app.outdir)
+    init_tracer(app)
+    app.imageext_main_pid = os.getpid()
 
 
 def on_doctree_read(app, doctree):
-    for image in doctree.traverse(nodes.image):
+    tracer = get_tracer(app)
+    with get_metrics(app).timer('doctree-read'):
+        with tracer.span('doctree-read', docname=app.env.docname):
+            process_doctree_read(app, doctree)
+
+    if tracer.enabled and tracer.is_forked():
+        # pass the spans recorded in parallel reading process via env-merge-info
+        events = getattr(app.env, 'imagehelper_trace_events', [])
+        app.env.imagehelper_trace_events = events + tracer.pop_events(os.getpid())
+
+
+def is_image(node):
+    return isinstance(node, (nodes.image, image_node))
+
+
+def parse_options(option):
+    if option not in PARSED_OPTIONS:
+        PARSED_OPTIONS[option] = parse_qs(option)
+
+    return PARSED_OPTIONS[option]
+
+
+def process_doctree_read(app, doctree):
+    for image in doctree.traverse(is_image):
+        if isinstance(image, image_node):
+            handler = get_imageext_handler_by_name(app, image['imageext_type'])
+            note_image(app, image, handler)
+            prefetch_image(app, image, handler)
+            continue
+
         handler = get_imageext_handler(app, image['uri'])
+        if handler is None and 'option' not in image:
+            continue
+
         option_spec = getattr(handler, 'option_spec', {})
 
-        options = cgi.parse_qs(image.get('option', ''))
+        options = parse_options(image.get('option', ''))
         for name in options:
             if name not in option_spec:
                 app.warn('Unsupported option `%s` found at %s' % (name, image['uri']))
@@ -64,88 +210,281 @@ def on_doctree_read(app, doctree):
                     app.warn('Fail to apply `%s` option to %s:\n%s' %
                              (name, image['uri'], ' '.join(exc.args)))
 
+        if handler:
+            note_image(app, image, handler)
+            prefetch_image(app, image, handler)
+
+
+def prefetch_image(app, image, handler):
+    # start the conversion in background while other documents are read;
+    # parallel reading processes exit before the conversions are collected
+    if not app.config.imagehelper_convert_on_read or os.getpid() != getattr(app, 'imageext_main_pid', None):
+        return
+
+    scheduler = get_scheduler(app)
+    converter = scheduler.get_converter(handler)
+    if converter.convert_many or converter.convert_async or is_fetchable(converter, image['uri']):
+        return  # dispatched together once reading has finished
+
+    paragraph = nodes.paragraph('', '', image.deepcopy())
+    converter.visit(app.env.docname, paragraph[0])
+    scheduler.dispatch(overlap=True)
+
+
+def get_handler_for(app, image):
+    if isinstance(image, image_node):
+        return get_imageext_handler_by_name(app, image['imageext_type'])
+    else:
+        return get_imageext_handler(app, image['uri'])
+
+
+def on_env_updated(app, env):
+    with get_metrics(app).timer('env-updated'):
+        with get_tracer(app).span('env-updated'):
+            dispatch_images(app, env)
+
+
+def dispatch_images(app, env):
+    # start the conversions of all documents read; each doctree-resolved waits only for its images
+    read_images = getattr(env, 'imagehelper_read_images', {})
+    env.imagehelper_read_images = {}  # not kept in the pickled environment
+
+    scheduler = get_scheduler(app)
+    for docname in sorted(read_images):
+        for image in read_images[docname]:
+            converter = scheduler.get_converter(get_handler_for(app, image))
+            paragraph = nodes.paragraph('', '', image)
+            converter.visit(docname, paragraph[0])
+    scheduler.dispatch()
+
 
 def on_doctree_resolved(app, doctree, docname):
-    for image in doctree.traverse(nodes.image):
-        handler = get_imageext_handler(app, image['uri'])
-        if handler:
-            handler(app).visit(docname, image)
+    with get_metrics(app).timer('doctree-resolved'):
+        with get_tracer(app).span('doctree-resolved', docname=docname):
+            process_doctree_resolved(app, doctree, docname)
 
-    for image in doctree.traverse(image_node):
-        handler = get_imageext_handler_by_name(app, image['imageext_type'])
+
+def process_doctree_resolved(app, doctree, docname):
+    # the doctree may contain the inlined documents (e.g. latex and singlehtml builders)
+    documents = getattr(app.env, 'imagehelper_images', {})
+    docnames = [docname] + [node['docname'] for node in doctree.traverse(addnodes.start_of_file)]
+    if not any(name in documents for name in docnames):
+        return
+
+    scheduler = get_scheduler(app)
+    for image in doctree.traverse(is_image):
+        handler = get_handler_for(app, image)
         if handler:
-            handler(app).visit(docname, image)
+            scheduler.get_converter(handler).visit(docname, image)
+
+    add_srcset(app, scheduler.flush())
+
+
+def on_build_finished(app, exc):
+    shutdown_scheduler(app, cancel=exc is not None)
+    if exc is None:
+        removed = get_manifest(app.env).collect_garbage(app.outdir)
+        if removed:
+            app.info('imagehelper: removed %d stale images' % len(removed))
+        save_manifest(app)
+    release_resources(app)
+
+
+def release_resources(app):
+    cleanup_cache(app)
+    fetcher = release_fetcher(app)
+    if fetcher:
+        get_metrics(app).record_fetcher(fetcher)
+    statcache = release_stat_cache(app)
+    if statcache:
+        get_metrics(app).record_stat_cache(statcache)
+    report_metrics(app)
+    save_tracer(app)
+    if not app.config.imagehelper_keep_workers:
+        shutdown_workers()
 
 
 class ImageConverter(object):
     option_spec = {}
+    version = ''
+    convert_many = None
+    convert_async = None
+    worker_command = None
+    worker_processes = 1
+    fetch_remote_images = False
+    output_formats = ()
+    config_keys = ()
+    timeout = None
+    memory_limit = None
+    cpu_limit = None
 
     def __init__(self, app):
         self.app = app
         self.warn = app.warn
 
     def visit(self, docname, image_node):
-        rel_imagedir, abs_imagedir = get_imagedir(self.app, docname)
-        basename = self.get_filename_for(image_node)
-        if URI_PATTERN.match(image_node['uri']):
-            srcpath = image_node['uri']
-        else:
-            srcpath = os.path.join(self.app.srcdir, image_node['uri'])
-        abs_imgpath = os.path.join(abs_imagedir, basename)
-
-        last_modified = self.get_last_modified_for(image_node)
-        if last_modified is None:
-            ret = False
-        elif not os.path.exists(abs_imgpath) or os.stat(abs_imgpath).st_mtime < last_modified:
-            ensuredir(os.path.dirname(abs_imgpath))
-            ret = self.convert(image_node,
-                               os.path.normpath(srcpath),
-                               os.path.normpath(abs_imgpath))
-        else:
-            ret = True
+        with get_tracer(self.app).span('visit', docname=docname, uri=image_node['uri']):
+            rel_imagedir, abs_imagedir = get_imagedir(self.app, docname)
+            basename = self.get_filename_for(image_node)
+            if is_fetchable(self, image_node['uri']):
+                srcpath = get_fetcher(self.app).get_path(image_node['uri'])
+            elif URI_PATTERN.match(image_node['uri']):
+                srcpath = image_node['uri']
+            else:
+                srcpath = os.path.join(self.app.srcdir, image_node['uri'])
 
-        if ret:
-            if last_modified is not None and os.path.exists(abs_imgpath):
-                os.utime(abs_imgpath, (last_modified, last_modified))
+            scheduler = get_scheduler(self.app)
+            if not self.output_formats:
+                abs_imgpath = os.path.join(abs_imagedir, basename)
+                rel_imgpath = posixpath.join(rel_imagedir, basename)
+                scheduler.submit(ConversionJob(self, image_node, srcpath, abs_imgpath, rel_imgpath, docname))
+                return
 
-            rel_imgpath = posixpath.join(rel_imagedir, basename)
-            newnode = nodes.image(**image_node.attributes)
-            newnode['candidates'] = {'*': rel_imgpath}
-            newnode['uri'] = rel_imgpath
-            image_node.replace_self(newnode)
-        else:
-            image_node.parent.remove(image_node)
+            supported = [ext for ext in self.output_formats
+                         if get_mimetype(ext) in self.app.builder.supported_image_types]
+            siblings = []
+            for ext in self.output_formats:
+                filename = os.path.splitext(basename)[0] + ext
+                if ext in (supported or self.output_formats[:1]):
+                    abs_imgpath = os.path.join(abs_imagedir, filename)
+                    rel_imgpath = posixpath.join(rel_imagedir, filename)
+                elif scheduler.cache:
+                    # not used by this builder; convert it to the cache for other builders
+                    # (the output is removed after stored)
+                    abs_imgpath = os.path.join(self.app.doctreedir, 'imagehelper_formats', filename)
+                    rel_imgpath = None
+                else:
+                    continue
+
+                job = ConversionJob(self, image_node, srcpath, abs_imgpath, rel_imgpath, docname)
+                job.cache_only = rel_imgpath is None
+                job.mimetype = get_mimetype(ext)
+                job.siblings = siblings
+                siblings.append(job)
+
+            for job in siblings:
+                scheduler.submit(job)
 
     def get_last_modified_for(self, node):
-        path = os.path.join(self.app.srcdir, node['uri'])
-        if os.path.exists(path):
-            return ceil(os.stat(path).st_mtime)
+        if is_fetchable(self, node['uri']):
+            path = get_fetcher(self.app).get_path(node['uri'])
         else:
+            path = os.path.join(self.app.srcdir, node['uri'])
+
+        statcache = get_stat_cache(self.app)
+        stat = statcache.stat(path)
+        if stat is None:
             return None
 
+        last_modified = stat.st_mtime
+        for path in self.get_dependencies_for(node):
+            stat = statcache.stat(os.path.join(self.app.srcdir, path))
+            if stat:
+                last_modified = max(last_modified, stat.st_mtime)
+
+        return ceil(last_modified)
+
+    def get_dependencies_for(self, node):
+        return []
+
+    def get_config_fingerprint(self):
+        return get_config_fingerprint(self.app.config, self.__class__)
+
     def get_filename_for(self, node):
         return os.path.splitext(node['uri'])[0] + '.png'
 
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        else:
+            return self.app.config.imagehelper_conversion_timeout
+
+    def get_resource_limits(self):
+        return (self.memory_limit or self.app.config.imagehelper_memory_limit,
+                self.cpu_limit or self.app.config.imagehelper_cpu_limit)
+
+    def run_command(self, command, **kwargs):
+        memory_limit, cpu_limit = self.get_resource_limits()
+        return run_command(command, self.get_timeout(), memory_limit, cpu_limit, **kwargs)
+
+    def scale(self, node, filename, to, width):
+        return scale_image(filename, to, width)
+    scale.requires_pillow = True
+
+    def get_worker_command(self):
+        return self.worker_command
+
     def convert(self, node, filename, to):
-        pass
+        if self.get_worker_command():
+            return self.convert_with_worker(node, filename, to)
+
+    def convert_with_worker(self, node, filename, to):
+        params = {
+            'filename': filename,
+            'to': to,
+            'format': self.app.builder.format,
+            'options': dict(get_options_for(self, node)),
+        }
+        try:
+            response = get_worker_group(self).request(params, self.get_timeout())
+        except WorkerError as exc:
+            self.warn('Fail to convert %s: %s' % (node['uri'], exc))
+            return False
+
+        if response.get('error'):
+            self.warn('Fail to convert %s: %s' % (node['uri'], response['error']))
+        return bool(response.get('result'))
+
+
+def setup(app):
+    app.add_node(image_node)
+    if sphinx.version_info >= (1, 8):  # older versions can't override the visitors of existing nodes
+        app.add_node(nodes.image, override=True, html=(visit_image, depart_image))
+    app.connect('builder-inited', on_builder_inited)
+    app.connect('doctree-read', on_doctree_read)
+    app.connect('doctree-resolved', on_doctree_resolved)
+    app.connect('env-purge-doc', on_env_purge_doc)
+    app.connect('env-merge-info', on_env_merge_info)
+    app.connect('env-get-outdated', on_env_get_outdated)
+    app.connect('env-updated', on_env_updated)
+    app.connect('build-finished', on_build_finished)
+    app.add_config_value('imagehelper_conversion_pool', 'thread', False)
+    app.add_config_value('imagehelper_conversion_workers', 1, False)
+    app.add_config_value('imagehelper_cache_dir', None, False)
+    app.add_config_value('imagehelper_cache_backend', None, False)
+    app.add_config_value('imagehelper_cache_size', 256 * 1024 * 1024, False)
+    app.add_config_value('imagehelper_keep_workers', False, False)
+    app.add_config_value('imagehelper_metrics_file', None, False)
+    app.add_config_value('imagehelper_trace_file', None, False)
+    app.add_config_value('imagehelper_async_concurrency', 8, False)
+    app.add_config_value('imagehelper_conversion_timeout', None, False)
+    app.add_config_value('imagehelper_memory_limit', None, False)
+    app.add_config_value('imagehelper_cpu_limit', None, False)
+    app.add_config_value('imagehelper_retry_failed', False, False)
+    app.add_config_value('imagehelper_fetch_connections', 4, False)
+    app.add_config_value('imagehelper_fetch_timeout', 30, False)
+    app.add_config_value('imagehelper_optimizers', [], False)
+    app.add_config_value('imagehelper_convert_on_read', False, False)
+    app.add_config_value('imagehelper_srcset_widths', None, 'html')
+    app.add_config_value('imagehelper_srcset_sizes', None, 'html')
+    app.add_config_value('imagehelper_image_dimensions', False, 'html')
+    app.imageext_registry = ImageTypeRegistry()
+    app.imageext_types = app.imageext_registry.types
+    app.imageext_url_patterns = app.imageext_registry.url_patterns
+
+    return {
+        'env_version': 2,
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
 
 
 def add_image_type(app, name, ext, handler):
     if not hasattr(app, 'imageext_types'):
-        app.add_node(image_node)
-        app.connect('builder-inited', on_builder_inited)
-        app.connect('doctree-read', on_doctree_read)
-        app.connect('doctree-resolved', on_doctree_resolved)
-        app.imageext_types = {}
-        app.imageext_url_patterns = {}
+        app.setup_extension('sphinxcontrib.imagehelper')
 
     if isinstance(ext, (list, tuple)):
         for e in ext:
             add_image_type(app, name, e, handler)
-    elif URI_PATTERN.match(ext):
-        app.imageext_url_patterns[ext] = (name, handler)
     else:
-        if ext.startswith('.'):
-            ext = ext[1:]
-
-        app.imageext_types[ext] = (name, handler)
+        app.imageext_registry.add(name, ext, handler)
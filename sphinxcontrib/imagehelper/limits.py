@@ -0,0 +1,90 @@
+import signal
+import threading
+import subprocess
+from math import ceil
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class ConversionTimeout(Exception):
+    pass
+
+
+def get_preexec_fn(memory_limit=None, cpu_limit=None):
+    if resource is None or not (memory_limit or cpu_limit):
+        return None
+
+    def set_limits():
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        if cpu_limit:
+            limit = int(ceil(cpu_limit))
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, limit))
+
+    return set_limits
+
+
+class ProcessWatchdog(object):
+    def __init__(self, process, timeout):
+        self.process = process
+        self.fired = False
+        if timeout:
+            self.timer = threading.Timer(timeout, self.kill)
+            self.timer.daemon = True
+        else:
+            self.timer = None
+
+    def kill(self):
+        self.fired = True
+        try:
+            self.process.kill()
+        except OSError:  # already exited
+            pass
+
+    def __enter__(self):
+        if self.timer:
+            self.timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.timer:
+            self.timer.cancel()
+
+
+def run_command(command, timeout=None, memory_limit=None, cpu_limit=None, input=None, **kwargs):
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('stderr', subprocess.PIPE)
+    if input is not None:
+        kwargs.setdefault('stdin', subprocess.PIPE)
+
+    process = subprocess.Popen(command, preexec_fn=get_preexec_fn(memory_limit, cpu_limit), **kwargs)
+    with ProcessWatchdog(process, timeout) as watchdog:
+        stdout, stderr = process.communicate(input)
+
+    if watchdog.fired:
+        raise ConversionTimeout('%s was killed; timed out after %s seconds' % (command[0], timeout))
+
+    return (process.returncode, stdout, stderr)
+
+
+@contextmanager
+def alarm(timeout):
+    # interrupt runaway conversion in the main thread of worker process
+    if not timeout or not hasattr(signal, 'setitimer'):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise ConversionTimeout('timed out after %s seconds' % timeout)
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
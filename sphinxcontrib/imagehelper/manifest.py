@@ -0,0 +1,185 @@
+import os
+from sphinxcontrib.imagehelper.cache import get_converter_name
+from sphinxcontrib.imagehelper.utils import get_temporary_path, replace
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+MANIFEST_FILENAME = 'imagehelper_manifest.pickle'
+
+
+class ManifestEntry(object):
+    def __init__(self, source, fingerprint, converter, version, options):
+        self.source = source
+        self.fingerprint = fingerprint
+        self.converter = converter
+        self.version = version
+        self.options = options
+        self.size = None
+        self.duration = None
+        self.failed = False
+        self.dimensions = None
+        self.docnames = set()
+
+    def matches(self, other):
+        return (self.fingerprint is not None and
+                self.source == other.source and
+                self.fingerprint == other.fingerprint and
+                self.converter == other.converter and
+                self.version == other.version and
+                self.options == other.options)
+
+
+class ConversionManifest(object):
+    def __init__(self):
+        self.entries = {}
+        self.documents = {}
+        self.dirty = False
+
+    def __getstate__(self):
+        # saved to its own file (see save_manifest); not pickled with the environment
+        return {'entries': {}, 'documents': {}, 'dirty': False}
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def get_entry_for(self, job):
+        _, source, options, _ = job.get_key()
+        fingerprint = (job.last_modified, job.converter.get_config_fingerprint())
+        return ManifestEntry(source, fingerprint,
+                             get_converter_name(job.converter), str(job.converter.version), options)
+
+    def is_up_to_date(self, job):
+        entry = self.entries.get(job.abs_imgpath)
+        return entry is not None and not entry.failed and entry.matches(self.get_entry_for(job))
+
+    def has_failed(self, job):
+        entry = self.entries.get(job.abs_imgpath)
+        return entry is not None and entry.failed and entry.matches(self.get_entry_for(job))
+
+    def get_dimensions(self, path):
+        return getattr(self.entries.get(path), 'dimensions', None)  # not recorded by older versions
+
+    def update(self, job, size=None, duration=None, dimensions=None):
+        entry = self.entries.get(job.abs_imgpath)
+        current = self.get_entry_for(job)
+        if entry is None or entry.failed or not entry.matches(current):
+            if entry:
+                current.docnames = entry.docnames
+            entry = self.entries[job.abs_imgpath] = current
+            self.dirty = True
+
+        if size is not None and entry.size != size:
+            entry.size = size
+            self.dirty = True
+        if duration is not None:
+            entry.duration = duration
+            self.dirty = True
+        if dimensions is not None and getattr(entry, 'dimensions', None) != dimensions:
+            entry.dimensions = dimensions
+            self.dirty = True
+        self.note_document(job.abs_imgpath, job.docname)
+
+    def record_failure(self, job, duration=None):
+        entry = self.get_entry_for(job)
+        entry.failed = True
+        entry.duration = duration
+        if job.abs_imgpath in self.entries:
+            entry.docnames = self.entries[job.abs_imgpath].docnames
+        self.entries[job.abs_imgpath] = entry
+        self.dirty = True
+        self.note_document(job.abs_imgpath, job.docname)
+
+    def invalidate(self, job):
+        entry = self.entries.get(job.abs_imgpath)
+        if entry:
+            entry.fingerprint = None
+            self.dirty = True
+
+    def discard(self, path):
+        if self.entries.pop(path, None) is not None:
+            self.dirty = True
+
+    def note_document(self, path, docname):
+        entry = self.entries.get(path)
+        if entry and docname and docname not in entry.docnames:
+            entry.docnames.add(docname)
+            self.documents.setdefault(docname, set()).add(path)
+            self.dirty = True
+
+    def purge_doc(self, docname):
+        for path in self.documents.pop(docname, []):
+            if path in self.entries:
+                self.entries[path].docnames.discard(docname)
+                self.dirty = True
+
+    def collect_garbage(self, outdir):
+        # remove outputs which are no longer referred from any documents
+        removed = []
+        outdir = os.path.join(os.path.normpath(outdir), '')
+        for path, entry in list(self.entries.items()):
+            if path.startswith(outdir) and not entry.docnames:
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed.append(path)
+                del self.entries[path]
+                self.dirty = True
+
+        return removed
+
+    def verify(self, outdir):
+        # forget outputs if their directory has been removed (cf. rm -rf _build/html/_images)
+        outdir = os.path.join(os.path.normpath(outdir), '')
+        dirnames = set(os.path.dirname(path) for path in self.entries if path.startswith(outdir))
+        missing = set(dirname for dirname in dirnames if not os.path.isdir(dirname))
+        for path in list(self.entries):
+            if os.path.dirname(path) in missing:
+                del self.entries[path]
+                self.dirty = True
+
+
+def get_manifest(env):
+    if not hasattr(env, 'imagehelper_manifest'):
+        env.imagehelper_manifest = ConversionManifest()
+
+    return env.imagehelper_manifest
+
+
+def load_manifest(app):
+    manifest = get_manifest(app.env)
+    path = os.path.join(app.doctreedir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        manifest.dirty = bool(manifest.entries)  # loaded from the environment of older versions
+        return manifest
+
+    try:
+        with open(path, 'rb') as fd:
+            state = pickle.load(fd)
+        manifest.entries = state['entries']
+        manifest.documents = state['documents']
+        manifest.dirty = False
+    except Exception as exc:
+        app.warn('Fail to load %s: %s' % (MANIFEST_FILENAME, exc))
+        manifest.entries = {}
+        manifest.documents = {}
+
+    # forget the documents unknown to the environment (e.g. fresh environment)
+    for docname in list(manifest.documents):
+        if docname not in app.env.all_docs:
+            manifest.purge_doc(docname)
+
+    return manifest
+
+
+def save_manifest(app):
+    manifest = getattr(app.env, 'imagehelper_manifest', None)
+    if manifest is not None and manifest.dirty:
+        manifest.dirty = False
+        path = os.path.join(app.doctreedir, MANIFEST_FILENAME)
+        tmppath = get_temporary_path(path)
+        with open(tmppath, 'wb') as fd:
+            state = {'entries': manifest.entries, 'documents': manifest.documents}
+            pickle.dump(state, fd, pickle.HIGHEST_PROTOCOL)
+        replace(tmppath, path)
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+COUNTERS = ('conversions', 'cache_hits', 'failures', 'bytes_written', 'bytes_saved', 'wall', 'cpu')
+
+
+def get_cpu_time():
+    if hasattr(time, 'thread_time'):  # Python 3.7+
+        cputime = time.thread_time()
+    elif hasattr(time, 'process_time'):  # Python 3.3+
+        cputime = time.process_time()
+    else:
+        cputime = time.clock()
+
+    if resource:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cputime += usage.ru_utime + usage.ru_stime
+
+    return cputime
+
+
+def measure(func, *args):
+    started = time.time()
+    cpu_started = get_cpu_time()
+    result = func(*args)
+    timing = {'started': started,
+              'wall': time.time() - started,
+              'cpu': get_cpu_time() - cpu_started,
+              'pid': os.getpid(),
+              'tid': threading.current_thread().ident}
+    return (result, timing)
+
+
+def new_stats():
+    return dict((name, 0) for name in COUNTERS)
+
+
+class ConversionMetrics(object):
+    def __init__(self):
+        self.total = new_stats()
+        self.converters = {}
+        self.sources = {}
+        self.hooks = {}
+        self.stat_cache = None
+        self.remote = None
+
+    def record(self, converter, source, **values):
+        for stats in (self.total,
+                      self.converters.setdefault(converter, new_stats()),
+                      self.sources.setdefault(source, new_stats())):
+            for name, value in values.items():
+                stats[name] += value
+
+    def record_hook(self, name, elapsed):
+        stats = self.hooks.setdefault(name, {'calls': 0, 'wall': 0})
+        stats['calls'] += 1
+        stats['wall'] += elapsed
+
+    def record_stat_cache(self, statcache):
+        self.stat_cache = {'hits': statcache.hits,
+                           'misses': statcache.misses,
+                           'hit_rate': statcache.hit_rate()}
+
+    def record_fetcher(self, fetcher):
+        self.remote = {'downloads': fetcher.downloads,
+                       'not_modified': fetcher.not_modified,
+                       'failures': fetcher.failures,
+                       'bytes_downloaded': fetcher.bytes_downloaded}
+
+    @contextmanager
+    def timer(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record_hook(name, time.time() - started)
+
+    def is_empty(self):
+        return not any(self.total.values())
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'converters': self.converters,
+            'sources': self.sources,
+            'hooks': self.hooks,
+            'stat_cache': self.stat_cache,
+            'remote': self.remote,
+        }
+
+    def summarize(self):
+        def format_stats(stats):
+            summary = ('%(conversions)d conversions, %(cache_hits)d cache hits, %(failures)d failures, '
+                       '%(bytes_written)d bytes written, %(wall).2fs wall, %(cpu).2fs cpu' % stats)
+            if stats['bytes_saved']:
+                summary += ', %(bytes_saved)d bytes saved by optimization' % stats
+            return summary
+
+        lines = ['imagehelper: ' + format_stats(self.total)]
+        for name in sorted(self.converters):
+            lines.append('    %s: %s' % (name, format_stats(self.converters[name])))
+        for name in sorted(self.hooks):
+            lines.append('    %s: %d calls, %.2fs' % (name, self.hooks[name]['calls'], self.hooks[name]['wall']))
+        if self.stat_cache:
+            lines.append('    stat cache: %d hits, %d misses (%.1f%% hit rate)' %
+                         (self.stat_cache['hits'], self.stat_cache['misses'], self.stat_cache['hit_rate'] * 100))
+        if self.remote:
+            lines.append('    remote images: %(downloads)d downloads, %(not_modified)d not modified, '
+                         '%(failures)d failures, %(bytes_downloaded)d bytes downloaded' % self.remote)
+
+        return lines
+
+
+def get_metrics(app):
+    metrics = getattr(app, 'imageext_metrics', None)
+    if metrics is None:
+        metrics = app.imageext_metrics = ConversionMetrics()
+
+    return metrics
+
+
+def report_metrics(app):
+    metrics = getattr(app, 'imageext_metrics', None)
+    if metrics is None:
+        return
+
+    app.imageext_metrics = None
+    if not metrics.is_empty():
+        for line in metrics.summarize():
+            app.info(line)
+
+    if app.config.imagehelper_metrics_file:
+        path = os.path.join(app.outdir, app.config.imagehelper_metrics_file)
+        with open(path, 'w') as fd:
+            json.dump(metrics.to_dict(), fd, indent=2, sort_keys=True)
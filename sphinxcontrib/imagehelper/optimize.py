@@ -0,0 +1,209 @@
+import os
+import re
+import zlib
+import struct
+import hashlib
+from sphinxcontrib.imagehelper.cache import BUFSIZE, ConversionCache
+from sphinxcontrib.imagehelper.utils import get_temporary_path, replace
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class ImageOptimizer(object):
+    # a stage to reduce size of converted images; subclass it to plug external tools (e.g. optipng)
+    extensions = ()
+    version = ''
+
+    def optimize(self, filename, to):
+        raise NotImplementedError
+
+
+class PNGOptimizer(ImageOptimizer):
+    extensions = ('.png',)
+    version = '1'
+
+    def optimize(self, filename, to):
+        # lossless: recompress image data with the best zlib settings
+        with open(filename, 'rb') as fd:
+            data = fd.read()
+        if not data.startswith(PNG_SIGNATURE):
+            return False
+
+        chunks = []
+        pos = len(PNG_SIGNATURE)
+        while pos + 8 <= len(data):
+            length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+            chunks.append((chunk_type, data[pos + 8:pos + 8 + length]))
+            pos += 12 + length
+
+        idat = b''.join(body for chunk_type, body in chunks if chunk_type == b'IDAT')
+        if not idat:
+            return False
+
+        raw = zlib.decompress(idat)
+        candidates = []
+        for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+            candidates.append(compressor.compress(raw) + compressor.flush())
+        compressed = min(candidates, key=len)
+
+        with open(to, 'wb') as fd:
+            fd.write(PNG_SIGNATURE)
+            written = False
+            for chunk_type, body in chunks:
+                if chunk_type == b'IDAT':
+                    if written:
+                        continue
+                    body = compressed
+                    written = True
+                fd.write(struct.pack('>I', len(body)) + chunk_type + body)
+                fd.write(struct.pack('>I', zlib.crc32(chunk_type + body) & 0xffffffff))
+        return True
+
+
+SVG_TOKENS = re.compile(br'<!\[CDATA\[.*?\]\]>|<!--.*?-->|<[?!].*?>|<(/?)([^\s/>]+)([^>]*?)(/?)>|[^<]+|<', re.S)
+SVG_SPACE = re.compile(br'xml:space\s*=\s*["\'](\w+)["\']')
+
+# whitespace between children of these elements is not rendered
+SVG_CONTAINERS = frozenset([
+    b'svg', b'g', b'defs', b'symbol', b'use', b'marker', b'pattern', b'mask', b'clipPath',
+    b'linearGradient', b'radialGradient', b'filter', b'switch',
+])
+
+
+class SVGOptimizer(ImageOptimizer):
+    extensions = ('.svg',)
+    version = '2'
+
+    def optimize(self, filename, to):
+        with open(filename, 'rb') as fd:
+            data = fd.read()
+
+        # remove comments, and indentation in the containers (not in <text> nor under xml:space="preserve")
+        output = []
+        stack = []  # (name, preserve)
+        for matched in SVG_TOKENS.finditer(data):
+            token = matched.group(0)
+            closing, name, attributes, empty = matched.group(1, 2, 3, 4)
+            if token.startswith(b'<!--'):
+                continue
+            elif name is None:
+                if not token.strip() and (not stack or stack[-1][0] in SVG_CONTAINERS and not stack[-1][1]):
+                    continue
+            elif closing:
+                while stack and stack.pop()[0] != name.split(b':')[-1]:
+                    pass
+            elif not empty:
+                space = SVG_SPACE.search(attributes)
+                if space:
+                    preserve = space.group(1) == b'preserve'
+                else:
+                    preserve = bool(stack) and stack[-1][1]
+                stack.append((name.split(b':')[-1], preserve))
+            output.append(token)
+
+        with open(to, 'wb') as fd:
+            fd.write(b''.join(output))
+        return True
+
+
+OPTIMIZERS = {
+    'png': PNGOptimizer,
+    'svg': SVGOptimizer,
+}
+
+
+def get_optimizers(app):
+    optimizers = []
+    for optimizer in app.config.imagehelper_optimizers or []:
+        if optimizer in OPTIMIZERS:
+            optimizers.append(OPTIMIZERS[optimizer]())
+        elif callable(optimizer):
+            optimizers.append(optimizer())
+        else:
+            app.warn('Unknown optimizer in imagehelper_optimizers: %s' % optimizer)
+
+    return optimizers
+
+
+def get_optimization_key(optimizers, filename):
+    hashed = hashlib.sha1(b'optimize')
+    for optimizer in optimizers:
+        cls = optimizer.__class__
+        hashed.update(('%s.%s:%s' % (cls.__module__, cls.__name__, optimizer.version)).encode('utf-8'))
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(BUFSIZE), b''):
+            hashed.update(chunk)
+
+    return hashed.hexdigest() + os.path.splitext(filename)[1]
+
+
+def optimize_image(optimizers, path):
+    # keep the outputs of optimizers only if they are smaller
+    for optimizer in optimizers:
+        tmppath = get_temporary_path(path)
+        try:
+            if optimizer.optimize(path, tmppath) and os.path.exists(tmppath) and \
+               os.path.getsize(tmppath) < os.path.getsize(path):
+                replace(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+
+class OptimizationStage(object):
+    def __init__(self, app, optimizers, cache=None):
+        self.app = app
+        self.optimizers = optimizers
+        if cache is None:
+            self.cache = ConversionCache(os.path.join(app.doctreedir, 'imagehelper_optimized'),
+                                         app.config.imagehelper_cache_size)
+            self.private_cache = True
+        else:
+            self.cache = cache
+            self.private_cache = False
+
+    def get_optimizers_for(self, path):
+        ext = os.path.splitext(path)[1].lower()
+        return [optimizer for optimizer in self.optimizers if ext in optimizer.extensions]
+
+    def run(self, jobs, pool=None):
+        # optimize the converted images (temporary files) before they are committed;
+        # returns the sizes of images before optimization
+        sizes = {}
+        pending = {}
+        duplicates = []
+        for job in jobs:
+            optimizers = self.get_optimizers_for(job.abs_imgpath)
+            if not optimizers or not job.tmppath or not os.path.exists(job.tmppath):
+                continue
+
+            sizes[job] = os.path.getsize(job.tmppath)
+            key = get_optimization_key(optimizers, job.tmppath)
+            if key in pending:  # same artifact is optimized by another job
+                duplicates.append((job, key))
+            elif self.cache.restore(key, job.tmppath):
+                continue
+            elif pool:
+                pending[key] = (job, pool.apply_async(optimize_image, (optimizers, job.tmppath)))
+            else:
+                pending[key] = (job, None)
+
+        for key, (job, result) in pending.items():
+            try:
+                if result is None:
+                    optimize_image(self.get_optimizers_for(job.abs_imgpath), job.tmppath)
+                else:
+                    result.get()
+                self.cache.store(key, job.tmppath)
+            except Exception as exc:
+                self.app.warn('Fail to optimize %s: %s' % (job.image_node['uri'], exc))
+
+        for job, key in duplicates:
+            self.cache.restore(key, job.tmppath)
+
+        return sizes
+
+    def close(self):
+        if self.private_cache:
+            self.cache.evict()
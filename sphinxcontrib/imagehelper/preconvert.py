@@ -0,0 +1,119 @@
+import io
+import os
+import re
+import sys
+import argparse
+import posixpath
+from docutils import nodes
+from sphinx.application import Sphinx
+from sphinx.util.matching import Matcher
+from sphinxcontrib.imagehelper.imageext import release_resources
+from sphinxcontrib.imagehelper.metrics import get_metrics
+from sphinxcontrib.imagehelper.scheduler import get_scheduler, shutdown_scheduler
+
+URL_CHARS = r'[^\s"\'<>`]*'
+
+
+def get_source_suffixes(config):
+    source_suffix = config.source_suffix
+    if isinstance(source_suffix, (list, tuple, dict)):
+        return tuple(source_suffix)
+    else:
+        return (source_suffix,)
+
+
+def find_images(app):
+    registry = app.imageext_registry
+    matcher = Matcher(app.config.exclude_patterns)
+    suffixes = get_source_suffixes(app.config)
+    if registry.url_matcher:
+        url_pattern = re.compile('(?:%s)%s' % (registry.url_matcher.pattern, URL_CHARS))
+    else:
+        url_pattern = None
+    builddirs = set(os.path.abspath(path) for path in (app.outdir, app.doctreedir))
+
+    images = set()
+    for root, dirs, files in os.walk(app.srcdir):
+        reldir = os.path.relpath(root, app.srcdir).replace(os.path.sep, '/')
+        dirs[:] = sorted(d for d in dirs
+                         if not d.startswith('.') and
+                         os.path.abspath(os.path.join(root, d)) not in builddirs and
+                         not matcher(posixpath.normpath(posixpath.join(reldir, d))))
+        for filename in files:
+            relpath = posixpath.normpath(posixpath.join(reldir, filename))
+            if matcher(relpath):
+                continue
+
+            if os.path.splitext(filename.lower())[1][1:] in registry.types:
+                images.add(relpath)
+            elif url_pattern and filename.endswith(suffixes):
+                with io.open(os.path.join(root, filename), encoding=app.config.source_encoding,
+                             errors='replace') as fd:
+                    for url in url_pattern.findall(fd.read()):
+                        images.add(url.rstrip('.,;:'))
+
+    return sorted(images)
+
+
+def preconvert(app, uris):
+    # output directory does not depend on documents; convert images as if they are placed at master_doc
+    docname = app.config.master_doc
+    scheduler = get_scheduler(app)
+    for uri in uris:
+        handler = app.imageext_registry.get_handler(uri)
+        if handler:
+            paragraph = nodes.paragraph('', '', nodes.image(uri=uri))  # converted node replaces itself
+            scheduler.get_converter(handler).visit(docname, paragraph[0])
+
+    scheduler.flush()
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='python -m sphinxcontrib.imagehelper',
+                                     description='Convert images of Sphinx project before sphinx-build')
+    parser.add_argument('sourcedir', help='path to documentation source files')
+    parser.add_argument('outputdir', help='path to output directory')
+    parser.add_argument('-b', dest='builder', default='html', help='builder name (default: html)')
+    parser.add_argument('-d', dest='doctreedir', help='path for the cached environment and doctree files')
+    parser.add_argument('-c', dest='confdir', help='path where configuration file (conf.py) is located')
+    parser.add_argument('-j', dest='jobs', type=int, help='imagehelper_conversion_workers')
+    parser.add_argument('-D', dest='define', action='append', default=[], metavar='setting=value',
+                        help='override a setting in configuration file')
+    parser.add_argument('-q', dest='quiet', action='store_true', help='no output on stdout, just warnings on stderr')
+    options = parser.parse_args(argv)
+
+    confoverrides = {}
+    for define in options.define:
+        if '=' not in define:
+            parser.error('-D option argument must be in the form name=value')
+        name, value = define.split('=', 1)
+        confoverrides[name] = value
+    if options.jobs:
+        confoverrides['imagehelper_conversion_workers'] = options.jobs
+
+    app = Sphinx(options.sourcedir,
+                 options.confdir or options.sourcedir,
+                 options.outputdir,
+                 options.doctreedir or os.path.join(options.outputdir, '.doctrees'),
+                 options.builder,
+                 confoverrides=confoverrides,
+                 status=None if options.quiet else sys.stdout)
+    if not hasattr(app, 'imageext_registry'):
+        sys.stderr.write('sphinxcontrib.imagehelper is not loaded; check extensions in conf.py\n')
+        return 2
+
+    uris = find_images(app)
+    app.info('imagehelper: found %d images' % len(uris))
+
+    metrics = get_metrics(app)
+    try:
+        preconvert(app, uris)
+    finally:
+        # do not touch the conversion manifest; sphinx-build picks up outputs via timestamps or cache
+        shutdown_scheduler(app)
+        release_resources(app)
+
+    if metrics.total['failures']:
+        return 1
+    else:
+        return 0
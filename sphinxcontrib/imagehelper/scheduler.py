@@ -0,0 +1,687 @@
+import os
+import time
+import threading
+import multiprocessing
+from itertools import count
+from multiprocessing.pool import ThreadPool
+from multiprocessing.queues import SimpleQueue
+from docutils import nodes
+from sphinx.util.osutil import ensuredir
+from sphinxcontrib.imagehelper.aio import TimeoutError, run_coroutines
+from sphinxcontrib.imagehelper.cache import get_cache, get_converter_name, get_options_for
+from sphinxcontrib.imagehelper.dimensions import get_image_dimensions
+from sphinxcontrib.imagehelper.fetch import get_fetcher, is_fetchable
+from sphinxcontrib.imagehelper.limits import ConversionTimeout, alarm
+from sphinxcontrib.imagehelper.manifest import get_manifest
+from sphinxcontrib.imagehelper.metrics import get_metrics, measure
+from sphinxcontrib.imagehelper.optimize import OptimizationStage, get_optimizers
+from sphinxcontrib.imagehelper.tracing import get_tracer
+from sphinxcontrib.imagehelper.statcache import get_stat_cache
+from sphinxcontrib.imagehelper.utils import get_temporary_path, replace
+
+POOL_TYPES = ('thread', 'process')
+WATCHDOG_GRACE = 1  # seconds; conversions are expected to stop by themselves in the meantime
+POLL_INTERVAL = 0.05  # seconds; tasks in the pool are checked for stall while waiting
+
+task_counter = count()
+
+# the application object (and the queue to notify started tasks) is inherited by forked worker processes
+_worker_app = None
+_worker_started = None
+
+
+def _convert_in_worker(handler, node, filename, to, timeout=None, method='convert', args=()):
+    with alarm(timeout):
+        return measure(getattr(handler(_worker_app), method), node, filename, to, *args)
+
+
+def _convert_many_in_worker(handler, items, timeout=None):
+    with alarm(timeout):
+        return measure(handler(_worker_app).convert_many, items)
+
+
+def _run_in_thread(task, attempt):
+    if not task.start(attempt):
+        return None  # moved to another pool
+    try:
+        return task.func(*task.args)
+    finally:
+        task.finish()
+
+
+def _run_in_worker(task_id, attempt, func, args):
+    _worker_started.put((task_id, attempt, time.time()))
+    return func(*args)
+
+
+class FinishedResult(object):
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+
+class FailedResult(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+    def get(self, timeout=None):
+        raise self.exc
+
+
+class BatchResult(object):
+    def __init__(self, result, size):
+        self.result = result
+        self.size = size
+        self.values = None
+
+    def get(self, timeout=None):
+        if self.values is None:
+            values, timing = self.result.get(timeout)
+            values = list(values or [])
+            if len(values) != self.size:
+                raise ValueError('convert_many() returned %d results for %d images' % (len(values), self.size))
+            self.values = (values, timing)
+
+        return self.values
+
+
+class BatchItem(object):
+    def __init__(self, result, index):
+        self.result = result
+        self.index = index
+
+    def get(self, timeout=None):
+        values, timing = self.result.get(timeout)
+        timing = dict(timing, wall=timing['wall'] / self.result.size, cpu=timing['cpu'] / self.result.size)
+        return (values[self.index], timing)
+
+
+class PoolTask(object):
+    # a task in the pool; its deadline starts when a worker picks it up
+    def __init__(self, scheduler, func, args, timeout=None, outputs=()):
+        self.id = next(task_counter)
+        self.scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.timeout = timeout
+        self.outputs = list(outputs)  # temporary files written by the task
+        self.lock = threading.Lock()
+        self.attempt = 0
+        self.started = None
+        self.finished = False
+        self.abandoned = False
+        self.stalled = False
+        self.result = None
+
+    def start(self, attempt):
+        with self.lock:
+            if attempt != self.attempt or self.abandoned:
+                return False
+            self.started = time.time()
+            return True
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+            abandoned = self.abandoned
+        if abandoned:
+            self.remove_outputs()
+
+    def abandon(self):
+        # threads can't be stopped; the running one removes its outputs when it finishes at last
+        with self.lock:
+            self.abandoned = True
+
+    def remove_outputs(self):
+        for path in self.outputs:
+            try:
+                os.remove(path)
+            except OSError:  # not written, or removed by the scheduler
+                pass
+
+    def requeue(self):
+        # take the task back from the old pool unless a worker has picked it up
+        with self.lock:
+            if self.started is not None:
+                return False
+            self.attempt += 1
+            return True
+
+    def is_stalled(self, now):
+        return bool(self.timeout and self.started and now > self.started + self.timeout + WATCHDOG_GRACE)
+
+    def get(self, timeout=None):
+        while True:
+            if self.stalled:
+                raise multiprocessing.TimeoutError()
+
+            result = self.result
+            try:
+                value = result.get(POLL_INTERVAL)
+            except multiprocessing.TimeoutError:
+                self.scheduler.check_stalled()
+                continue
+
+            if result is self.result:  # not a result from the replaced pool
+                return value
+
+
+class ConversionJob(object):
+    def __init__(self, converter, image_node, srcpath, abs_imgpath, rel_imgpath, docname=None):
+        self.converter = converter
+        self.docname = docname
+        self.image_node = image_node
+        self.srcpath = os.path.normpath(srcpath)
+        self.abs_imgpath = os.path.normpath(abs_imgpath)
+        self.rel_imgpath = rel_imgpath
+        self.last_modified = None
+        self.cache_key = None
+        self.tmppath = None
+        self.started = None
+        self.primary = None
+        self.up_to_date = False
+        self.failed_before = False
+        self.converting = False
+        self.succeeded = None
+        self.mimetype = None
+        self.siblings = None
+        self.cache_only = False  # converted only to be stored to the cache
+        self.method = 'convert'  # or the stage deriving output from other one (e.g. 'scale')
+        self.args = ()
+        self.dimensions = None
+        self.result_node = None
+
+    def get_key(self):
+        options = tuple((name, repr(value)) for name, value in get_options_for(self.converter, self.image_node))
+        return (self.converter.__class__, self.srcpath, options, self.abs_imgpath)
+
+    def is_outdated(self, statcache):
+        stat = statcache.stat(self.abs_imgpath)
+        if stat is None:
+            return True
+        else:
+            return stat.st_mtime < self.last_modified
+
+    def prepare(self):
+        ensuredir(os.path.dirname(self.abs_imgpath))
+        self.tmppath = get_temporary_path(self.abs_imgpath)
+        self.started = time.time()
+        self.converting = True
+
+    def run(self):
+        return measure(getattr(self.converter, self.method), self.image_node, self.srcpath, self.tmppath, *self.args)
+
+    def commit(self, succeeded, statcache):
+        if self.tmppath and os.path.exists(self.tmppath):
+            if succeeded:
+                replace(self.tmppath, self.abs_imgpath)
+                statcache.invalidate(self.abs_imgpath)
+            else:
+                try:
+                    os.remove(self.tmppath)
+                except OSError:  # removed by the abandoned conversion
+                    pass
+        self.tmppath = None
+
+        if succeeded and not self.up_to_date and self.last_modified is not None and \
+           statcache.exists(self.abs_imgpath):
+            os.utime(self.abs_imgpath, (self.last_modified, self.last_modified))
+            statcache.invalidate(self.abs_imgpath)
+        self.succeeded = bool(succeeded)
+
+    def discard(self, statcache):
+        if os.path.exists(self.abs_imgpath):
+            os.remove(self.abs_imgpath)
+            statcache.invalidate(self.abs_imgpath)
+
+    def finish(self, succeeded):
+        self.succeeded = bool(succeeded)
+        if self.siblings:
+            # the outputs in multiple formats replace the node together
+            if any(job.succeeded is None for job in self.siblings):
+                return
+            outputs = [job for job in self.siblings if job.succeeded and job.rel_imgpath]
+        elif succeeded:
+            outputs = [self]
+        else:
+            outputs = []
+
+        image_node = self.image_node
+        if outputs:
+            newnode = nodes.image(**image_node.attributes)
+            if self.siblings:
+                newnode['candidates'] = dict((job.mimetype or '*', job.rel_imgpath) for job in outputs)
+            else:
+                newnode['candidates'] = {'*': self.rel_imgpath}
+            newnode['uri'] = outputs[0].rel_imgpath
+            dimensions = set(job.dimensions for job in outputs)
+            if len(dimensions) == 1 and None not in dimensions:
+                newnode['intrinsic_width'], newnode['intrinsic_height'], dpi = dimensions.pop()
+                if dpi:
+                    newnode['intrinsic_dpi'] = dpi
+            image_node.replace_self(newnode)
+            self.result_node = newnode
+        elif image_node.parent is not None:
+            image_node.parent.remove(image_node)
+
+
+class ConversionScheduler(object):
+    def __init__(self, app, pool_type='thread', workers=1, cache=None, concurrency=None, retry_failed=False):
+        if pool_type not in POOL_TYPES:
+            app.warn('Unknown imagehelper_conversion_pool: %s (use thread)' % pool_type)
+            pool_type = 'thread'
+        elif pool_type == 'process' and not hasattr(os, 'fork'):
+            app.warn('process pool is not supported on this platform (use thread)')
+            pool_type = 'thread'
+
+        self.app = app
+        self.pool_type = pool_type
+        self.workers = workers or multiprocessing.cpu_count()
+        self.cache = cache
+        self.concurrency = concurrency
+        self.retry_failed = retry_failed
+        self.metrics = get_metrics(app)
+        self.tracer = get_tracer(app)
+        self.statcache = get_stat_cache(app)
+        self.manifest = get_manifest(app.env)
+        optimizers = get_optimizers(app)
+        if optimizers:
+            self.optimizer = OptimizationStage(app, optimizers, cache)
+        else:
+            self.optimizer = None
+        self.pool = None
+        self.started_queue = None
+        self.tasks = {}
+        self.pending = []
+        self.background = {}  # dispatched jobs and their results; applied on flush
+        self.jobs = {}
+        self.converters = {}
+
+    def get_converter(self, handler):
+        if handler not in self.converters:
+            self.converters[handler] = handler(self.app)
+
+        return self.converters[handler]
+
+    def submit(self, job):
+        key = job.get_key()
+        if key in self.jobs:
+            job.primary = self.jobs[key]
+        else:
+            self.jobs[key] = job
+        self.pending.append(job)
+
+    def check(self, job):
+        job.last_modified = job.converter.get_last_modified_for(job.image_node)
+        if job.last_modified is None:
+            self.record(job, failures=1)
+            return FinishedResult(False)
+
+        if self.manifest.has_failed(job) and not self.retry_failed:
+            self.app.warn('Skip converting %s; it failed in the previous build '
+                          '(set imagehelper_retry_failed to retry)' % job.image_node['uri'])
+            job.failed_before = True
+            self.record(job, failures=1)
+            return FinishedResult(False)
+
+        # decide from the manifest; the stat cache confirms that the output has not been removed
+        if not job.cache_only and self.manifest.is_up_to_date(job) and self.statcache.exists(job.abs_imgpath):
+            job.up_to_date = True
+            self.record(job, cache_hits=1)
+            return FinishedResult(True)
+
+        if self.cache:
+            job.cache_key = self.cache.get_key(job.converter, job.image_node, job.srcpath, job.abs_imgpath,
+                                               (job.method,) + job.args if job.args else ())
+            if job.cache_only and job.cache_key and self.cache.contains(job.cache_key):
+                self.record(job, cache_hits=1)
+                return FinishedResult(True)
+            elif job.cache_key and self.cache.restore(job.cache_key, job.abs_imgpath):
+                self.statcache.invalidate(job.abs_imgpath)
+                self.record(job, cache_hits=1)
+                return FinishedResult(True)
+
+        # the timestamp of output is used only for images unknown to the manifest;
+        # changes of config values and converters are not reflected to it
+        if job.cache_key is None and not job.cache_only and job.abs_imgpath not in self.manifest and \
+           not job.is_outdated(self.statcache):
+            self.record(job, cache_hits=1)
+            return FinishedResult(True)
+
+        return None
+
+    def update_manifest(self, job, succeeded):
+        if job.primary:
+            if succeeded:
+                job.dimensions = job.primary.dimensions
+                self.manifest.note_document(job.abs_imgpath, job.docname)
+        elif job.failed_before:
+            self.manifest.note_document(job.abs_imgpath, job.docname)
+        elif job.cache_only:
+            if succeeded:
+                self.manifest.discard(job.abs_imgpath)  # not kept as output
+            else:
+                self.manifest.invalidate(job)
+        elif job.up_to_date:
+            # the dimensions are measured once; unchanged images are not read again
+            job.dimensions = self.manifest.get_dimensions(job.abs_imgpath)
+            if job.dimensions is None:
+                job.dimensions = get_image_dimensions(job.abs_imgpath)
+            self.manifest.update(job, dimensions=job.dimensions)
+        elif not succeeded:
+            self.manifest.invalidate(job)
+        else:
+            stat = self.statcache.stat(job.abs_imgpath)
+            job.dimensions = get_image_dimensions(job.abs_imgpath)
+            self.manifest.update(job, size=stat.st_size if stat else None, dimensions=job.dimensions)
+
+    def record(self, job, **values):
+        self.metrics.record(get_converter_name(job.converter), job.image_node['uri'], **values)
+
+    def submit_task(self, task):
+        self.tasks[task.id] = task
+        if self.pool_type == 'process':
+            task.result = self.get_pool().apply_async(_run_in_worker, (task.id, task.attempt, task.func, task.args))
+        else:
+            task.result = self.get_pool().apply_async(_run_in_thread, (task, task.attempt))
+        return task
+
+    def run(self, job, overlap=False):
+        timeout = job.converter.get_timeout()
+        if self.workers == 1 and not timeout and not overlap:
+            return FinishedResult(job.run())
+
+        if self.pool_type == 'process':
+            args = (job.converter.__class__, job.image_node.deepcopy(), job.srcpath, job.tmppath, timeout,
+                    job.method, job.args)
+            return self.submit_task(PoolTask(self, _convert_in_worker, args, timeout, [job.tmppath]))
+        else:
+            return self.submit_task(PoolTask(self, job.run, (), timeout, [job.tmppath]))
+
+    def run_batch(self, converter, jobs, overlap=False):
+        timeout = converter.get_timeout()
+        if timeout:
+            timeout *= len(jobs)
+
+        if self.workers == 1 and not timeout and not overlap:
+            items = [(job.image_node, job.srcpath, job.tmppath) for job in jobs]
+            return FinishedResult(measure(converter.convert_many, items))
+
+        outputs = [job.tmppath for job in jobs]
+        if self.pool_type == 'process':
+            items = [(job.image_node.deepcopy(), job.srcpath, job.tmppath) for job in jobs]
+            return self.submit_task(PoolTask(self, _convert_many_in_worker, (converter.__class__, items, timeout),
+                                             timeout, outputs))
+        else:
+            items = [(job.image_node, job.srcpath, job.tmppath) for job in jobs]
+            return self.submit_task(PoolTask(self, measure, (converter.convert_many, items), timeout, outputs))
+
+    def receive_started(self):
+        # the tasks in worker processes notify when they are picked up
+        while self.started_queue is not None and not self.started_queue.empty():
+            task_id, attempt, started = self.started_queue.get()
+            task = self.tasks.get(task_id)
+            if task is not None and task.attempt == attempt:
+                task.started = started
+
+    def check_stalled(self):
+        self.receive_started()
+        now = time.time()
+        stalled = False
+        for task in list(self.tasks.values()):
+            if task.result.ready():
+                del self.tasks[task.id]
+            elif task.is_stalled(now):
+                task.stalled = True
+                task.abandon()
+                del self.tasks[task.id]
+                stalled = True
+
+        if stalled:
+            self.replace_pool()
+
+    def replace_pool(self):
+        # the stalled tasks occupy workers; move the waiting tasks to a new pool
+        pool, self.pool = self.pool, None
+        if self.pool_type == 'process':
+            pool.terminate()  # kill the runaway workers; the running tasks are started again
+            for task in list(self.tasks.values()):
+                task.attempt += 1
+                task.started = None
+                self.submit_task(task)
+        else:
+            pool.close()  # threads can't be killed; they exit after the current tasks
+            for task in list(self.tasks.values()):
+                if task.requeue():
+                    self.submit_task(task)
+
+    def wait(self, job, result):
+        try:
+            return result.get()
+        except multiprocessing.TimeoutError:  # the conversion does not respond; it is left behind
+            return self.timed_out(job)
+        except ConversionTimeout:
+            return self.timed_out(job)
+
+    def timed_out(self, job):
+        self.app.warn('Conversion of %s timed out after %s seconds' %
+                      (job.image_node['uri'], job.converter.get_timeout()))
+        timing = {'started': job.started,
+                  'wall': time.time() - job.started,
+                  'cpu': 0.0,
+                  'pid': os.getpid(),
+                  'tid': threading.current_thread().ident}
+        return (False, timing)
+
+    def fetch(self, jobs):
+        urls = [job.image_node['uri'] for job in jobs
+                if not job.primary and is_fetchable(job.converter, job.image_node['uri'])]
+        if urls:
+            with self.tracer.span('fetch', urls=len(urls)):
+                for path in get_fetcher(self.app).fetch_many(urls).values():
+                    if path:
+                        self.statcache.invalidate(path)
+
+    def run_coroutines(self, jobs):
+        calls = [(job, job.converter.convert_async, (job.image_node, job.srcpath, job.tmppath),
+                  job.converter.get_timeout()) for job in jobs]
+        results = {}
+        for job, (value, exc, timing) in run_coroutines(calls, self.concurrency).items():
+            if isinstance(exc, TimeoutError):
+                results[job] = FinishedResult(self.timed_out(job))
+            elif exc:
+                results[job] = FailedResult(exc)
+            else:
+                results[job] = FinishedResult((value, timing))
+
+        return results
+
+    def start(self, jobs, overlap=False):
+        self.fetch(jobs)
+
+        results = {}
+        batches = {}
+        coroutines = []
+        for job in jobs:
+            if job.primary:
+                continue
+
+            results[job] = self.check(job)
+            if results[job] is None:
+                job.prepare()
+                if job.method != 'convert':
+                    results[job] = self.run(job, overlap)
+                elif job.converter.convert_async:
+                    coroutines.append(job)
+                elif job.converter.convert_many:
+                    batches.setdefault(job.converter, []).append(job)
+                else:
+                    results[job] = self.run(job, overlap)
+
+        for converter, batch in batches.items():
+            result = BatchResult(self.run_batch(converter, batch, overlap), len(batch))
+            for i, job in enumerate(batch):
+                results[job] = BatchItem(result, i)
+
+        # coroutines run on this thread while the pool converts other images
+        if coroutines:
+            results.update(self.run_coroutines(coroutines))
+
+        return results
+
+    def dispatch(self, overlap=False):
+        # start the pending jobs without waiting for them; they are applied on flush
+        jobs, self.pending = self.pending, []
+        results = self.start(jobs, overlap)
+        for job in jobs:
+            if not job.primary:
+                self.background[job] = results[job]
+
+    def collect(self, jobs=None):
+        # apply the dispatched jobs which the given jobs depend on (all of them if not given)
+        if jobs is None:
+            collected = list(self.background)
+        else:
+            collected = []
+            for job in jobs:
+                if job.primary in self.background and job.primary not in collected:
+                    collected.append(job.primary)
+
+        if collected:
+            self.apply(collected, dict((job, self.background.pop(job)) for job in collected))
+
+    def flush(self):
+        jobs, self.pending = self.pending, []
+        self.collect(jobs)
+        self.apply(jobs, self.start(jobs))
+        return jobs
+
+    def apply(self, jobs, results):
+        # apply results in submission order to keep output deterministic
+        try:
+            outcomes = {}
+            for job in jobs:
+                if not job.primary and job.converting:
+                    outcomes[job] = self.wait(job, results[job])
+            original_sizes = self.optimize([job for job in jobs if job in outcomes and outcomes[job][0]])
+
+            for job in jobs:
+                if job.primary:
+                    succeeded = job.primary.succeeded
+                    self.update_manifest(job, succeeded)
+                elif job.converting:
+                    succeeded, timing = outcomes[job]
+                    job.commit(succeeded, self.statcache)
+                    self.tracer.add('convert', timing['started'], timing['wall'],
+                                    {'uri': job.image_node['uri'], 'docname': job.docname},
+                                    timing['pid'], timing['tid'])
+                    if succeeded:
+                        stat = self.statcache.stat(job.abs_imgpath)
+                        size = stat.st_size if stat else 0
+                        saved = max(original_sizes.get(job, size) - size, 0)
+                        self.record(job, conversions=1, bytes_written=size, bytes_saved=saved,
+                                    wall=timing['wall'], cpu=timing['cpu'])
+                        if job.cache_only:
+                            self.manifest.discard(job.abs_imgpath)
+                        else:
+                            job.dimensions = get_image_dimensions(job.abs_imgpath)
+                            self.manifest.update(job, size, timing['wall'], job.dimensions)
+                        if job.cache_key:
+                            self.cache.store(job.cache_key, job.abs_imgpath)
+                    else:
+                        self.record(job, conversions=1, failures=1, wall=timing['wall'], cpu=timing['cpu'])
+                        self.manifest.record_failure(job, timing['wall'])
+                else:
+                    succeeded = results[job].get()
+                    job.commit(succeeded, self.statcache)
+                    self.update_manifest(job, succeeded)
+                if job.cache_only:
+                    job.discard(self.statcache)
+                job.finish(succeeded)
+        except BaseException:
+            for job in jobs:
+                if job.succeeded is None:
+                    job.commit(False, self.statcache)
+            raise
+
+    def optimize(self, jobs):
+        if self.optimizer is None or not jobs:
+            return {}
+
+        if self.workers > 1:
+            pool = self.get_pool()
+        else:
+            pool = None
+        with self.tracer.span('optimize', images=len(jobs)):
+            return self.optimizer.run(jobs, pool)
+
+    def get_pool(self):
+        if self.pool is None:
+            if self.pool_type == 'process':
+                global _worker_app, _worker_started
+                _worker_app = self.app
+                context = getattr(multiprocessing, 'get_context', None)
+                if context:  # Python 3.4+
+                    _worker_started = self.started_queue = context('fork').SimpleQueue()
+                    self.pool = context('fork').Pool(self.workers)
+                else:
+                    _worker_started = self.started_queue = SimpleQueue()
+                    self.pool = multiprocessing.Pool(self.workers)
+            else:
+                self.pool = ThreadPool(self.workers)
+
+        return self.pool
+
+    def terminate(self):
+        # kill runaway conversions; a new pool is created on demand
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self.tasks = {}
+
+    def cancel(self):
+        # stop conversions in the pool (e.g. on build failure) and remove their temporary files;
+        # the running threads remove their own when they finish
+        jobs, self.background = list(self.background), {}
+        self.pending = []
+        for task in self.tasks.values():
+            task.abandon()
+        self.terminate()
+        for job in jobs:
+            if job.succeeded is None:
+                job.commit(False, self.statcache)
+
+    def shutdown(self, cancel=False):
+        if cancel:
+            self.cancel()
+        elif self.background:
+            self.collect()
+        if self.optimizer is not None:
+            self.optimizer.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def get_scheduler(app):
+    scheduler = getattr(app, 'imageext_scheduler', None)
+    if scheduler is None:
+        scheduler = ConversionScheduler(app,
+                                        app.config.imagehelper_conversion_pool,
+                                        app.config.imagehelper_conversion_workers,
+                                        get_cache(app),
+                                        app.config.imagehelper_async_concurrency,
+                                        app.config.imagehelper_retry_failed)
+        app.imageext_scheduler = scheduler
+
+    return scheduler
+
+
+def shutdown_scheduler(app, cancel=False):
+    scheduler = getattr(app, 'imageext_scheduler', None)
+    if scheduler is not None:
+        scheduler.shutdown(cancel)
+        app.imageext_scheduler = None
@@ -0,0 +1,69 @@
+import os
+import posixpath
+from docutils import nodes
+from sphinxcontrib.imagehelper.scheduler import ConversionJob, get_scheduler
+from sphinxcontrib.imagehelper.utils import get_mimetype
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+RASTER_TYPES = ('image/png', 'image/jpeg', 'image/gif')
+
+
+def scale_image(filename, to, width):
+    image = Image.open(filename)
+    height = max(int(round(image.size[1] * width / float(image.size[0]))), 1)
+    resample = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+    image.resize((width, height), resample).save(to)
+    return True
+
+
+def get_variant_path(path, width):
+    basename, ext = posixpath.splitext(path)
+    return '%s-%dw%s' % (basename, width, ext)
+
+
+def add_srcset(app, jobs):
+    widths = app.config.imagehelper_srcset_widths
+    if not widths or app.builder.format != 'html':
+        return
+
+    scheduler = get_scheduler(app)
+    images = []
+    for job in jobs:
+        node = job.result_node
+        if node is None or job.siblings or get_mimetype(os.path.splitext(job.abs_imgpath)[1]) not in RASTER_TYPES:
+            continue
+        if Image is None and getattr(job.converter.scale, 'requires_pillow', False):
+            if not getattr(app, 'imageext_srcset_warned', False):
+                app.warn('Pillow is required to generate srcset (skipped)')
+                app.imageext_srcset_warned = True
+            continue
+
+        size = job.dimensions
+        if size is None:
+            continue
+
+        variants = []
+        for width in sorted(set(widths)):
+            if width < size[0]:
+                paragraph = nodes.paragraph('', '', nodes.image(**job.image_node.attributes))
+                variant = ConversionJob(job.converter, paragraph[0], job.abs_imgpath,
+                                        get_variant_path(job.abs_imgpath, width),
+                                        get_variant_path(job.rel_imgpath, width), job.docname)
+                variant.method = 'scale'
+                variant.args = (width,)
+                scheduler.submit(variant)
+                variants.append(variant)
+        images.append((node, job, size[0], variants))
+
+    # scaled variants are converted in the pool as well as other images
+    scheduler.flush()
+    for node, job, width, variants in images:
+        srcset = ['%s %dw' % (variant.rel_imgpath, variant.args[0]) for variant in variants if variant.succeeded]
+        if srcset:
+            node['srcset'] = ', '.join(srcset + ['%s %dw' % (job.rel_imgpath, width)])
+            if app.config.imagehelper_srcset_sizes:
+                node['sizes'] = app.config.imagehelper_srcset_sizes
@@ -0,0 +1,61 @@
+import os
+
+
+class StatCache(object):
+    def __init__(self):
+        self.stats = {}
+        self.readable = {}
+        self.hits = 0
+        self.misses = 0
+
+    def stat(self, path):
+        if path in self.stats:
+            self.hits += 1
+        else:
+            self.misses += 1
+            try:
+                self.stats[path] = os.stat(path)
+            except OSError:
+                self.stats[path] = None
+
+        return self.stats[path]
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def is_readable(self, path):
+        if path in self.readable:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.readable[path] = os.access(path, os.R_OK)
+
+        return self.readable[path]
+
+    def invalidate(self, path):
+        self.stats.pop(path, None)
+        self.readable.pop(path, None)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        else:
+            return float(self.hits) / total
+
+
+def get_stat_cache(app):
+    if app is None:
+        return StatCache()
+
+    statcache = getattr(app, 'imageext_statcache', None)
+    if statcache is None:
+        statcache = app.imageext_statcache = StatCache()
+
+    return statcache
+
+
+def release_stat_cache(app):
+    statcache = getattr(app, 'imageext_statcache', None)
+    app.imageext_statcache = None
+    return statcache
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import threading
+
+
+class Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add(self.name, self.started, time.time() - self.started, self.args)
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class Tracer(object):
+    enabled = True
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.events = []
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def add(self, name, started, duration, args, pid=None, tid=None):
+        if pid is None:
+            pid = os.getpid()
+        if tid is None:
+            tid = threading.current_thread().ident
+
+        self.events.append({'name': name, 'cat': 'imagehelper', 'ph': 'X',
+                            'ts': int(started * 1000000), 'dur': int(duration * 1000000),
+                            'pid': pid, 'tid': tid, 'args': args})
+
+    def is_forked(self):
+        return self.pid != os.getpid()
+
+    def pop_events(self, pid):
+        events = [event for event in self.events if event['pid'] == pid]
+        self.events = [event for event in self.events if event['pid'] != pid]
+        return events
+
+    def save(self):
+        with open(self.path, 'w') as fd:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fd)
+
+
+class NullTracer(object):
+    enabled = False
+    span_context = NullSpan()
+
+    def span(self, name, **args):
+        return self.span_context
+
+    def add(self, name, started, duration, args, pid=None, tid=None):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+def get_tracer(app):
+    return getattr(app, 'imageext_tracer', None) or NULL_TRACER
+
+
+def init_tracer(app):
+    if app.config.imagehelper_trace_file:
+        path = os.path.join(app.outdir, app.config.imagehelper_trace_file)
+        app.imageext_tracer = Tracer(path)
+    else:
+        app.imageext_tracer = None
+
+
+def save_tracer(app):
+    tracer = getattr(app, 'imageext_tracer', None)
+    if tracer is not None:
+        tracer.save()
+        app.imageext_tracer = None
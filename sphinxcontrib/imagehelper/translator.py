@@ -0,0 +1,30 @@
+def get_image_attributes(node, dimensions=False):
+    attrs = []
+    if node.get('srcset'):
+        attrs.append(('srcset', node['srcset']))
+        if node.get('sizes'):
+            attrs.append(('sizes', node['sizes']))
+
+    # intrinsic size reserves the space for the image; not to shift layout on loading.
+    # height: auto keeps the aspect ratio when the image is shrunk (e.g. by max-width)
+    if dimensions and 'intrinsic_width' in node and not any(name in node for name in ('width', 'height', 'scale')):
+        attrs.append(('width', node['intrinsic_width']))
+        attrs.append(('height', node['intrinsic_height']))
+        attrs.append(('style', 'height: auto;'))
+
+    return attrs
+
+
+def visit_image(self, node):
+    self.__class__.visit_image(self, node)
+    attrs = get_image_attributes(node, self.builder.config.imagehelper_image_dimensions)
+    if attrs:
+        attrs = ''.join(' %s="%s"' % (name, self.attval(str(value))) for name, value in attrs)
+        for i in range(len(self.body) - 1, -1, -1):
+            if self.body[i].startswith('<img '):
+                self.body[i] = '<img' + attrs + self.body[i][4:]
+                break
+
+
+def depart_image(self, node):
+    self.__class__.depart_image(self, node)
@@ -1,6 +1,11 @@
 import os
+import mimetypes
+from itertools import count
 from sphinx.util.osutil import relative_uri
 
+replace = getattr(os, 'replace', os.rename)  # Python 3.3+
+tmpfile_counter = count()
+
 
 def get_imagedir(app, docname):
     if hasattr(app.builder, 'imagedir'):  # Sphinx (>= 1.3.x)
@@ -17,3 +22,14 @@ def get_imagedir(app, docname):
 
     abspath = os.path.join(app.builder.outdir, dirname)
     return (relpath, abspath)
+
+
+def get_temporary_path(path):
+    # keep the extension of the path; some converters determine output format from it
+    dirname, basename = os.path.split(path)
+    tmpname = '.%d-%d-%s' % (os.getpid(), next(tmpfile_counter), basename)
+    return os.path.join(dirname, tmpname)
+
+
+def get_mimetype(ext):
+    return mimetypes.guess_type('image' + ext)[0]
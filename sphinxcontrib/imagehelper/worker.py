@@ -0,0 +1,128 @@
+import json
+import atexit
+import threading
+import subprocess
+from itertools import count
+from sphinxcontrib.imagehelper.limits import ProcessWatchdog, get_preexec_fn
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2.x
+    from Queue import Queue
+
+# worker groups are kept across builds in the same process
+_worker_groups = {}
+_worker_groups_lock = threading.Lock()
+
+
+class WorkerError(Exception):
+    pass
+
+
+class ConverterWorker(object):
+    def __init__(self, command, preexec_fn=None):
+        self.command = list(command)
+        self.preexec_fn = preexec_fn
+        self.process = None
+        self.counter = count()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        preexec_fn=self.preexec_fn)
+
+    def request(self, params, timeout=None):
+        if not self.is_alive():
+            self.start()
+
+        message = dict(params, id=next(self.counter))
+        try:
+            with ProcessWatchdog(self.process, timeout) as watchdog:
+                self.process.stdin.write((json.dumps(message, default=str) + '\n').encode('utf-8'))
+                self.process.stdin.flush()
+                response = self.process.stdout.readline()
+        except (IOError, OSError) as exc:
+            self.stop()
+            raise WorkerError('Fail to communicate with worker %r: %s' % (self.command, exc))
+
+        if watchdog.fired:
+            self.stop()
+            raise WorkerError('Worker %r was killed; timed out after %s seconds' % (self.command, timeout))
+
+        if not response:
+            self.stop()
+            raise WorkerError('Worker %r exited unexpectedly' % (self.command,))
+
+        response = json.loads(response.decode('utf-8'))
+        if response.get('id') != message['id']:
+            self.stop()
+            raise WorkerError('Worker %r returned response for unknown request' % (self.command,))
+
+        return response
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                try:
+                    self.process.stdin.close()  # worker exits on EOF
+                    self.process.wait()
+                except (IOError, OSError):
+                    self.process.kill()
+            self.process = None
+
+
+class WorkerGroup(object):
+    def __init__(self, command, size=1, preexec_fn=None):
+        self.command = command
+        self.size = size
+        self.preexec_fn = preexec_fn
+        self.workers = []
+        self.idle = Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and len(self.workers) < self.size:
+                worker = ConverterWorker(self.command, self.preexec_fn)
+                self.workers.append(worker)
+                return worker
+
+        return self.idle.get()
+
+    def release(self, worker):
+        self.idle.put(worker)
+
+    def request(self, params, timeout=None):
+        worker = self.acquire()
+        try:
+            return worker.request(params, timeout)
+        finally:
+            self.release(worker)
+
+    def shutdown(self):
+        with self.lock:
+            for worker in self.workers:
+                worker.stop()
+
+
+def get_worker_group(converter):
+    command = tuple(converter.get_worker_command())
+    key = (converter.__class__, command)
+    with _worker_groups_lock:
+        if key not in _worker_groups:
+            preexec_fn = get_preexec_fn(*converter.get_resource_limits())
+            _worker_groups[key] = WorkerGroup(command, converter.worker_processes, preexec_fn)
+
+        return _worker_groups[key]
+
+
+def shutdown_workers():
+    with _worker_groups_lock:
+        for group in _worker_groups.values():
+            group.shutdown()
+        _worker_groups.clear()
+
+
+atexit.register(shutdown_workers)
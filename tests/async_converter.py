@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# converters using coroutines (Python 3.5+)
+
+import sys
+import asyncio
+from sphinxcontrib.imagehelper import ImageConverter
+
+
+class AsyncImageConverter(ImageConverter):
+    running = 0
+    max_running = 0
+
+    def get_filename_for(self, node):
+        return node['uri'].replace('.img', '.png')
+
+    async def convert_async(self, node, filename, to):
+        cls = self.__class__
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        try:
+            command = [sys.executable, '-c', 'import shutil, sys; shutil.copyfile(sys.argv[1], sys.argv[2])',
+                       filename, to]
+            process = await asyncio.create_subprocess_exec(*command)
+            return await process.wait() == 0
+        finally:
+            cls.running -= 1
+
+
+class HangingImageConverter(AsyncImageConverter):
+    async def convert_async(self, node, filename, to):
+        if node['uri'] == 'hang.img':
+            await asyncio.sleep(60)
+        return await super(HangingImageConverter, self).convert_async(node, filename, to)
+
+
+async def interrupt():
+    await asyncio.sleep(0.01)
+    raise KeyboardInterrupt
+
+
+async def wait_forever(cancelled):
+    try:
+        await asyncio.sleep(60)
+    except asyncio.CancelledError:
+        cancelled.append(True)
+        raise
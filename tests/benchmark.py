@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for sphinxcontrib-imagehelper on synthetic projects.
+
+usage: python tests/benchmark.py [--docs N] [--images N] [--patterns N]
+                                 [--cache cold|warm|touched] [--output FILE]
+
+The results are printed (or written to FILE) as JSON.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+from shutil import copyfile
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import sphinx
+from sphinx.application import Sphinx
+from sphinxcontrib.imagehelper import add_image_type, add_image_directive, ImageConverter
+
+CACHE_STATES = ('cold', 'warm', 'touched')
+CONF_PY = '''
+import sys
+sys.path.insert(0, %(benchdir)r)
+import benchmark
+
+master_doc = 'index'
+imagehelper_trace_file = 'trace.json'
+imagehelper_conversion_workers = %(workers)d
+imagehelper_cache_dir = %(cachedir)r
+
+
+def setup(app):
+    benchmark.setup_project(app, %(patterns)d)
+'''
+
+
+class CopyingImageConverter(ImageConverter):
+    def get_filename_for(self, node):
+        return node['uri'].replace('/', '-').replace('.img', '.png')
+
+    def convert(self, node, filename, to):
+        copyfile(filename, to)
+        return True
+
+
+def setup_project(app, patterns):
+    add_image_type(app, 'bench', 'img', CopyingImageConverter)
+    for i in range(patterns):
+        add_image_type(app, 'bench%d' % i, 'http://diagram%d.example.com/' % i, CopyingImageConverter)
+    add_image_directive(app, 'bench')
+
+
+def generate_project(basedir, options):
+    srcdir = os.path.join(basedir, 'src')
+    os.makedirs(os.path.join(srcdir, 'images'))
+
+    cachedir = os.path.join(basedir, 'cache') if options.cache_dir else None
+    with open(os.path.join(srcdir, 'conf.py'), 'w') as fd:
+        fd.write(CONF_PY % dict(benchdir=os.path.dirname(os.path.abspath(__file__)),
+                                workers=options.workers,
+                                cachedir=cachedir,
+                                patterns=options.patterns))
+
+    docnames = ['doc%d' % i for i in range(options.docs)]
+    with open(os.path.join(srcdir, 'index.rst'), 'w') as fd:
+        fd.write('index\n=====\n\n.. toctree::\n\n')
+        for docname in docnames:
+            fd.write('   %s\n' % docname)
+
+    for i, docname in enumerate(docnames):
+        with open(os.path.join(srcdir, docname + '.rst'), 'w') as fd:
+            fd.write('%s\n%s\n\n' % (docname, '=' * len(docname)))
+            for j in range(options.images):
+                # half of images are shared between documents
+                if j % 2:
+                    filename = 'images/shared%d.img' % j
+                    fd.write('.. bench-image:: %s\n\n' % filename)
+                else:
+                    filename = 'images/%s-%d.img' % (docname, j)
+                    fd.write('.. image:: %s\n\n' % filename)
+
+                with open(os.path.join(srcdir, filename), 'w') as img:
+                    img.write(filename)
+
+    return srcdir
+
+
+def touch_images(srcdir):
+    timestamp = time.time() + 10
+    for dirpath, _, filenames in os.walk(os.path.join(srcdir, 'images')):
+        for filename in filenames:
+            os.utime(os.path.join(dirpath, filename), (timestamp, timestamp))
+
+
+def run_build(srcdir, builddir, options, freshenv=False):
+    outdir = os.path.join(builddir, options.builder)
+    doctreedir = os.path.join(builddir, 'doctrees')
+    app = Sphinx(srcdir, srcdir, outdir, doctreedir, options.builder,
+                 status=StringIO(), warning=StringIO(), freshenv=freshenv, parallel=options.jobs)
+
+    started = time.time()
+    app.build()
+    elapsed = time.time() - started
+
+    spans = {}
+    with open(os.path.join(outdir, 'trace.json')) as fd:
+        for event in json.load(fd)['traceEvents']:
+            span = spans.setdefault(event['name'], {'calls': 0, 'total': 0.0})
+            span['calls'] += 1
+            span['total'] += event['dur'] / 1000000.0
+
+    return {'build': elapsed, 'spans': spans}
+
+
+def run_benchmark(options):
+    basedir = tempfile.mkdtemp()
+    try:
+        srcdir = generate_project(basedir, options)
+        builddir = os.path.join(basedir, '_build')
+
+        results = []
+        for _ in range(options.repeat):
+            if options.cache == 'cold':
+                shutil.rmtree(builddir, ignore_errors=True)
+            elif not os.path.exists(builddir):
+                run_build(srcdir, builddir, options)  # warm up outputs
+
+            if options.cache == 'touched':
+                touch_images(srcdir)
+
+            results.append(run_build(srcdir, builddir, options, freshenv=True))
+
+        return results
+    finally:
+        shutil.rmtree(basedir)
+
+
+def get_revision():
+    try:
+        basedir = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=basedir, stderr=subprocess.STDOUT)
+        return output.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark sphinxcontrib-imagehelper')
+    parser.add_argument('--docs', type=int, default=100, help='number of documents')
+    parser.add_argument('--images', type=int, default=4, help='number of images per document')
+    parser.add_argument('--patterns', type=int, default=0, help='number of registered URL patterns')
+    parser.add_argument('--cache', choices=CACHE_STATES, default='cold', help='state of converted images')
+    parser.add_argument('--cache-dir', action='store_true', help='enable content-addressed conversion cache')
+    parser.add_argument('--workers', type=int, default=1, help='imagehelper_conversion_workers')
+    parser.add_argument('--builder', default='html', help='builder name')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='parallel build')
+    parser.add_argument('--repeat', type=int, default=3, help='number of measured builds')
+    parser.add_argument('--output', help='write results to the file')
+    options = parser.parse_args(argv)
+
+    params = vars(options).copy()
+    params.pop('output')
+    results = run_benchmark(options)
+    report = {
+        'params': params,
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'sphinx': sphinx.__display_version__,
+        'results': results,
+        'best': min(result['build'] for result in results),
+    }
+
+    if options.output:
+        with open(options.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# A fake converter worker for tests; it copies the source image to the target.
+
+import os
+import sys
+import json
+import time
+from shutil import copyfile
+
+
+def main():
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+
+        request = json.loads(line)
+        time.sleep(request.get('sleep', 0))
+        response = {'id': request['id'], 'pid': os.getpid()}
+        try:
+            copyfile(request['filename'], request['to'])
+            response['result'] = True
+        except (IOError, OSError) as exc:
+            response['result'] = False
+            response['error'] = str(exc)
+
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.aio import run_coroutines
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+if sys.version_info >= (3, 5):
+    from async_converter import AsyncImageConverter, HangingImageConverter, interrupt, wait_forever
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'coroutines are not supported')
+class TestSphinxcontrib(unittest.TestCase):
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_convert_async(self, app, status, warnings):
+        """
+        .. image:: 1.img
+        .. image:: 2.img
+        .. image:: 3.img
+        .. image:: 4.img
+        .. image:: 5.img
+        """
+        for i in range(1, 6):
+            (app.srcdir / ('%d.img' % i)).write_text('image%d' % i)
+        add_image_type(app, 'name', '.img', AsyncImageConverter)
+        app.config.imagehelper_async_concurrency = 2
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+        for i in range(1, 6):
+            self.assertIn('src="_images/%d.png"' % i, html)
+            with open(app.outdir / '_images' / ('%d.png' % i)) as fd:
+                self.assertEqual('image%d' % i, fd.read())
+        self.assertEqual(2, AsyncImageConverter.max_running)
+        self.assertIn('imagehelper: 5 conversions', status.getvalue())
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_convert_async_across_documents(self, app, status, warnings):
+        docnames = ['doc%d' % i for i in range(4)]
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   ' + '\n   '.join(docnames))
+        for docname in docnames:
+            (app.srcdir / (docname + '.rst')).write_text('%s\n====\n\n.. image:: %s.img\n' % (docname, docname))
+            (app.srcdir / (docname + '.img')).write_text(docname)
+        AsyncImageConverter.max_running = 0
+        add_image_type(app, 'name', '.img', AsyncImageConverter)
+        app.config.imagehelper_async_concurrency = 4
+        on_builder_inited(app)
+        app.build()
+
+        # the coroutines of all documents run in one event loop
+        self.assertEqual(4, AsyncImageConverter.max_running)
+        for docname in docnames:
+            with open(app.outdir / (docname + '.html')) as fd:
+                self.assertIn('src="_images/%s.png"' % docname, fd.read())
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_convert_async_with_timeout(self, app, status, warnings):
+        """
+        .. image:: hang.img
+        .. image:: example.img
+        """
+        (app.srcdir / 'hang.img').write_text('')
+        (app.srcdir / 'example.img').write_text('')
+        add_image_type(app, 'name', '.img', HangingImageConverter)
+        app.config.imagehelper_conversion_timeout = 0.5
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+        self.assertNotIn('hang', html)
+        self.assertIn('src="_images/example.png"', html)
+        self.assertIn('Conversion of hang.img timed out after 0.5 seconds', warnings.getvalue())
+        self.assertEqual(['example.png'], (app.outdir / '_images').listdir())
+
+    def test_run_coroutines_on_interruption(self):
+        cancelled = []
+        calls = [('interrupt', interrupt, (), None), ('wait', wait_forever, (cancelled,), None)]
+        with self.assertRaises(KeyboardInterrupt):
+            run_coroutines(calls)
+        self.assertEqual([True], cancelled)
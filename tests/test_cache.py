@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from mock import Mock
+from shutil import copyfile
+from sphinx_testing import with_app
+from docutils.parsers.rst import directives
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.cache import CacheBackend, ConversionCache, SQLiteCache, get_cache
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class CountingImageConverter(ImageConverter):
+    option_spec = {
+        'foo': directives.positive_int,
+    }
+    converted = []
+
+    def get_filename_for(self, node):
+        return 'converted.png'
+
+    def convert(self, node, filename, to):
+        self.converted.append(filename)
+        copyfile(filename, to)
+        return True
+
+
+class DictCache(CacheBackend):
+    # stand-in for remote key/value storage shared between build nodes
+    storage = {}
+
+    def load(self, key):
+        return self.storage.get(key)
+
+    def save(self, key, data):
+        self.storage[key] = data
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        CountingImageConverter.converted = []
+        DictCache.storage = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_conversion_cache(self, app, status, warnings):
+        """
+        .. image:: example.img
+           :option: foo=1
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', CountingImageConverter)
+        app.config.imagehelper_cache_dir = self.cachedir
+        on_builder_inited(app)
+
+        # first build: converted and stored to cache
+        app.build()
+        self.assertEqual(1, len(CountingImageConverter.converted))
+        self.assertTrue((app.outdir / '_images' / 'converted.png').exists())
+
+        # second build (after make clean): restored from cache
+        shutil.rmtree(app.outdir)
+        (app.srcdir / 'example.img').utime((time.time() + 1, time.time() + 1))
+        app.build()
+        self.assertEqual(1, len(CountingImageConverter.converted))
+        self.assertTrue((app.outdir / '_images' / 'converted.png').exists())
+
+        # third build (image has changed)
+        (app.srcdir / 'example.img').write_text('modified')
+        (app.srcdir / 'example.img').utime((time.time() + 2, time.time() + 2))
+        app.build()
+        self.assertEqual(2, len(CountingImageConverter.converted))
+        with open(app.outdir / '_images' / 'converted.png') as fd:
+            self.assertEqual('modified', fd.read())
+
+    def test_cache_key(self):
+        srcfile = os.path.join(self.cachedir, 'example.img')
+        with open(srcfile, 'w') as fd:
+            fd.write('image')
+
+        class AnotherImageConverter(CountingImageConverter):
+            pass
+
+        cache = ConversionCache(os.path.join(self.cachedir, 'cache'))
+        converter = CountingImageConverter(Mock())
+        key = cache.get_key(converter, {'foo': 1}, srcfile, 'converted.png')
+        self.assertEqual(key, cache.get_key(converter, {'foo': 1}, srcfile, 'converted.png'))
+        self.assertNotEqual(key, cache.get_key(converter, {'foo': 2}, srcfile, 'converted.png'))
+        self.assertNotEqual(key, cache.get_key(converter, {'foo': 1}, srcfile, 'converted.svg'))
+        self.assertNotEqual(key, cache.get_key(AnotherImageConverter(Mock()), {'foo': 1}, srcfile, 'converted.png'))
+
+        converter.version = '2.0'
+        self.assertNotEqual(key, cache.get_key(converter, {'foo': 1}, srcfile, 'converted.png'))
+
+        # unreadable source
+        self.assertIsNone(cache.get_key(converter, {}, 'http://example.com/example.img', 'converted.png'))
+
+    def test_cache_key_with_config_and_dependencies(self):
+        srcfile = os.path.join(self.cachedir, 'example.img')
+        depfile = os.path.join(self.cachedir, 'palette.txt')
+        for filename in (srcfile, depfile):
+            with open(filename, 'w') as fd:
+                fd.write('image')
+
+        class PaletteImageConverter(CountingImageConverter):
+            config_keys = ('palette',)
+
+            def get_dependencies_for(self, node):
+                return ['palette.txt']
+
+        cache = ConversionCache(os.path.join(self.cachedir, 'cache'))
+        converter = PaletteImageConverter(Mock(srcdir=self.cachedir, config=Mock(palette='default')))
+        key = cache.get_key(converter, {}, srcfile, 'converted.png')
+        self.assertEqual(key, cache.get_key(converter, {}, srcfile, 'converted.png'))
+
+        converter.app.config.palette = 'dark'
+        self.assertNotEqual(key, cache.get_key(converter, {}, srcfile, 'converted.png'))
+
+        converter.app.config.palette = 'default'
+        with open(depfile, 'w') as fd:
+            fd.write('modified')
+        self.assertNotEqual(key, cache.get_key(converter, {}, srcfile, 'converted.png'))
+
+    def test_evict(self):
+        cache = ConversionCache(os.path.join(self.cachedir, 'cache'), max_size=10)
+        srcfile = os.path.join(self.cachedir, 'example.png')
+        with open(srcfile, 'w') as fd:
+            fd.write('12345')
+
+        for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+            cache.store(key, srcfile)
+            os.utime(cache.get_path(key), (i, i))
+        self.assertTrue(cache.restore('aa1', os.path.join(self.cachedir, 'restored.png')))
+
+        cache.evict()
+        self.assertTrue(os.path.exists(cache.get_path('aa1')))
+        self.assertFalse(os.path.exists(cache.get_path('bb2')))
+        self.assertTrue(os.path.exists(cache.get_path('cc3')))
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_custom_cache_backend(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', CountingImageConverter)
+        app.config.imagehelper_cache_backend = DictCache
+        on_builder_inited(app)
+
+        app.build()
+        self.assertEqual(1, len(CountingImageConverter.converted))
+        self.assertEqual([b'image'], list(DictCache.storage.values()))
+        key = list(DictCache.storage)[0]
+        self.assertTrue(key.endswith('.png'))
+
+        # another node: restored from the shared storage
+        shutil.rmtree(app.outdir)
+        (app.srcdir / 'example.img').utime((time.time() + 1, time.time() + 1))
+        app.build()
+        self.assertEqual(1, len(CountingImageConverter.converted))
+        with open(app.outdir / '_images' / 'converted.png') as fd:
+            self.assertEqual('image', fd.read())
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_sqlite_cache_backend(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', CountingImageConverter)
+        app.config.imagehelper_cache_dir = self.cachedir
+        app.config.imagehelper_cache_backend = 'sqlite'
+        on_builder_inited(app)
+
+        app.build()
+        self.assertEqual(1, len(CountingImageConverter.converted))
+        self.assertEqual(['cache.sqlite'], [name for name in os.listdir(self.cachedir) if name.endswith('.sqlite')])
+
+        shutil.rmtree(app.outdir)
+        (app.srcdir / 'example.img').utime((time.time() + 1, time.time() + 1))
+        app.build()
+        self.assertEqual(1, len(CountingImageConverter.converted))
+        self.assertTrue((app.outdir / '_images' / 'converted.png').exists())
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_unknown_cache_backend(self, app, status, warnings):
+        app.config.imagehelper_cache_dir = self.cachedir
+        add_image_type(app, 'name', '.img', CountingImageConverter)
+        app.config.imagehelper_cache_backend = 'unknown'
+        self.assertIsInstance(get_cache(app), ConversionCache)
+        self.assertIn('Unknown imagehelper_cache_backend: unknown', warnings.getvalue())
+
+    def test_sqlite_cache(self):
+        cache = SQLiteCache(os.path.join(self.cachedir, 'cache'), max_size=10)
+        srcfile = os.path.join(self.cachedir, 'example.png')
+        restored = os.path.join(self.cachedir, 'restored.png')
+        with open(srcfile, 'w') as fd:
+            fd.write('12345')
+
+        self.assertFalse(cache.restore('aa1', restored))
+        for key in ['aa1', 'bb2', 'cc3']:
+            cache.store(key, srcfile)
+            time.sleep(0.01)
+        self.assertTrue(cache.restore('aa1', restored))
+        with open(restored) as fd:
+            self.assertEqual('12345', fd.read())
+
+        # read concurrently from threads
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.load('cc3'))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([b'12345'] * 4, results)
+
+        cache.evict()
+        cache.close()
+
+        cache = SQLiteCache(os.path.join(self.cachedir, 'cache'))
+        self.assertEqual(b'12345', cache.load('aa1'))
+        self.assertIsNone(cache.load('bb2'))
+        self.assertEqual(b'12345', cache.load('cc3'))
+        cache.close()
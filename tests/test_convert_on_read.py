@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import threading
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class MyImageConverter(ImageConverter):
+    converted = []
+    started = threading.Event()
+
+    def get_filename_for(self, node):
+        return os.path.splitext(node['uri'])[0] + '.png'
+
+    def convert(self, node, filename, to):
+        self.converted.append(node['uri'])
+        self.started.set()
+        with open(to, 'w') as fd:
+            fd.write('converted')
+        return True
+
+
+class SlowImageConverter(MyImageConverter):
+    def convert(self, node, filename, to):
+        with open(to, 'w') as fd:
+            fd.write('partial')
+        self.started.set()
+        time.sleep(0.5)
+        return True
+
+
+class LateImageConverter(MyImageConverter):
+    running = []
+    finished = []
+    release = threading.Event()
+
+    def convert(self, node, filename, to):
+        self.running.append(node['uri'])
+        self.release.wait(5)
+        with open(to, 'w') as fd:
+            fd.write('converted')
+        self.finished.append(node['uri'])
+        return True
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        MyImageConverter.converted = []
+        MyImageConverter.started = threading.Event()
+        LateImageConverter.running = []
+        LateImageConverter.finished = []
+        LateImageConverter.release = threading.Event()
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_convert_on_read(self, app, status, warnings):
+        """
+        .. image:: example.img
+
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        app.config.imagehelper_convert_on_read = True
+        on_builder_inited(app)
+
+        # conversions have been started while reading documents
+        started = []
+        app.connect('doctree-read', lambda app, doctree: started.append(MyImageConverter.started.wait(5)))
+        app.build()
+
+        self.assertEqual([True], started)
+        self.assertEqual(['example.img'], MyImageConverter.converted)
+        with open(app.outdir / '_images' / 'example.png') as fd:
+            self.assertEqual('converted', fd.read())
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertEqual(2, fd.read().count('<img alt="_images/example.png" src="_images/example.png" />'))
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_convert_on_read_disabled(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        on_builder_inited(app)
+
+        converted = []
+        app.connect('doctree-read', lambda app, doctree: converted.extend(MyImageConverter.converted))
+        app.build()
+
+        self.assertEqual([], converted)
+        self.assertEqual(['example.img'], MyImageConverter.converted)
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_convert_on_read_with_build_failure(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        def fail(app, doctree):
+            if app.env.docname == 'zzz':
+                MyImageConverter.started.wait(5)
+                raise RuntimeError('build failed')
+
+        (app.srcdir / 'example.img').write_text('image')
+        (app.srcdir / 'zzz.rst').write_text('broken\n======\n')
+        add_image_type(app, 'name', '.img', SlowImageConverter)
+        app.config.imagehelper_convert_on_read = True
+        on_builder_inited(app)
+        app.connect('doctree-read', fail)
+
+        with self.assertRaises(RuntimeError):
+            app.build()
+
+        # the running conversion is discarded with its temporary file
+        imagedir = app.outdir / '_images'
+        self.assertEqual([], os.listdir(imagedir) if os.path.exists(imagedir) else [])
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_convert_on_read_with_running_conversions(self, app, status, warnings):
+        def fail(app, env):
+            # fail after the workers have picked up both conversions
+            wait_for(lambda: len(LateImageConverter.running) == 2)
+            raise RuntimeError('build failed')
+
+        (app.srcdir / 'contents.rst').write_text('.. image:: 1.img\n\n.. image:: 2.img\n')
+        (app.srcdir / '1.img').write_text('image')
+        (app.srcdir / '2.img').write_text('image')
+        add_image_type(app, 'name', '.img', LateImageConverter)
+        app.config.imagehelper_convert_on_read = True
+        app.config.imagehelper_conversion_workers = 2
+        on_builder_inited(app)
+        app.connect('env-updated', fail)
+
+        with self.assertRaises(RuntimeError):
+            app.build()
+
+        # the cancelled conversions remove their temporary files when they finish
+        LateImageConverter.release.set()
+        imagedir = app.outdir / '_images'
+        wait_for(lambda: len(LateImageConverter.finished) == 2 and os.listdir(imagedir) == [])
+        self.assertEqual(['1.img', '2.img'], sorted(LateImageConverter.finished))
+        self.assertEqual([], os.listdir(imagedir))
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_convert_on_read_with_queued_conversions(self, app, status, warnings):
+        def fail(app, env):
+            # 2.img waits in the queue while 1.img occupies the only worker
+            wait_for(lambda: LateImageConverter.running == ['1.img'])
+            raise RuntimeError('build failed')
+
+        (app.srcdir / 'contents.rst').write_text('.. image:: 1.img\n\n.. image:: 2.img\n')
+        (app.srcdir / '1.img').write_text('image')
+        (app.srcdir / '2.img').write_text('image')
+        add_image_type(app, 'name', '.img', LateImageConverter)
+        app.config.imagehelper_convert_on_read = True
+        on_builder_inited(app)
+        app.connect('env-updated', fail)
+
+        with self.assertRaises(RuntimeError):
+            app.build()
+
+        # the queued conversion never starts, and leaves no file
+        LateImageConverter.release.set()
+        imagedir = app.outdir / '_images'
+        wait_for(lambda: LateImageConverter.finished == ['1.img'] and os.listdir(imagedir) == [])
+        time.sleep(0.5)
+        self.assertEqual(['1.img'], LateImageConverter.running)
+        self.assertEqual(['1.img'], LateImageConverter.finished)
+        self.assertEqual([], os.listdir(imagedir))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+from time import time
+from shutil import copyfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited, on_env_get_outdated
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class PaletteImageConverter(ImageConverter):
+    config_keys = ('palette_name',)
+    converted = []
+
+    def get_filename_for(self, node):
+        return 'converted.png'
+
+    def get_dependencies_for(self, node):
+        return ['palettes/%s.txt' % self.app.config.palette_name]
+
+    def convert(self, node, filename, to):
+        self.converted.append(node['uri'])
+        copyfile(filename, to)
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        PaletteImageConverter.converted = []
+
+    def setup_project(self, app):
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   doc1\n   doc2\n')
+        (app.srcdir / 'doc1.rst').write_text('doc1\n====\n\n.. image:: example.img\n')
+        (app.srcdir / 'doc2.rst').write_text('doc2\n====\n\ntext only\n')
+        (app.srcdir / 'example.img').write_text('image')
+        (app.srcdir / 'palettes').makedirs()
+        (app.srcdir / 'palettes' / 'default.txt').write_text('default')
+        (app.srcdir / 'palettes' / 'dark.txt').write_text('dark')
+        app.add_config_value('palette_name', 'default', '')
+        add_image_type(app, 'name', '.img', PaletteImageConverter)
+        on_builder_inited(app)
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_dependencies(self, app, status, warnings):
+        self.setup_project(app)
+        app.build()
+        self.assertEqual(['example.img'], PaletteImageConverter.converted)
+        self.assertIn('palettes/default.txt', app.env.dependencies['doc1'])
+
+        # nothing is converted if dependencies are not changed
+        app.build()
+        self.assertEqual(['example.img'], PaletteImageConverter.converted)
+
+        # the document and the image are rebuilt if the dependency is changed
+        timestamp = time() + 10
+        os.utime(app.srcdir / 'palettes' / 'default.txt', (timestamp, timestamp))
+        app.build()
+        self.assertEqual(['example.img', 'example.img'], PaletteImageConverter.converted)
+        self.assertIn('1 changed', status.getvalue())
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_config_keys(self, app, status, warnings):
+        self.setup_project(app)
+        app.build()
+        self.assertEqual(['example.img'], PaletteImageConverter.converted)
+        self.assertEqual(1, len(app.env.imagehelper_config_fingerprints))
+
+        # the documents using the images are rebuilt if config values are changed
+        app.config.palette_name = 'dark'
+        outdated = on_env_get_outdated(app, app.env, set(), set(), set())
+        self.assertEqual(['doc1'], outdated)
+
+        app.config.palette_name = 'default'
+        on_env_get_outdated(app, app.env, set(), set(), set())
+        app.build()
+        self.assertEqual(['example.img'], PaletteImageConverter.converted)
+
+        app.config.palette_name = 'dark'
+        app.build()
+        self.assertEqual(['example.img', 'example.img'], PaletteImageConverter.converted)
+        self.assertIn('palettes/dark.txt', app.env.dependencies['doc1'])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import zlib
+import shutil
+import struct
+import tempfile
+from mock import patch
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.dimensions import get_image_dimensions
+from sphinxcontrib.imagehelper.manifest import get_manifest
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+def write_chunk(fd, chunk_type, body):
+    fd.write(struct.pack('>I', len(body)) + chunk_type + body)
+    fd.write(struct.pack('>I', zlib.crc32(chunk_type + body) & 0xffffffff))
+
+
+def write_png(path, width, height, dpi=None):
+    with open(path, 'wb') as fd:
+        fd.write(b'\x89PNG\r\n\x1a\n')
+        write_chunk(fd, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+        if dpi:
+            ppm = int(round(dpi / 0.0254))
+            write_chunk(fd, b'pHYs', struct.pack('>IIB', ppm, ppm, 1))
+        write_chunk(fd, b'IEND', b'')
+
+
+class PNGImageConverter(ImageConverter):
+    def convert(self, node, filename, to):
+        write_png(to, 300, 200, dpi=144)
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_intrinsic_dimensions(self, app, status, warnings):
+        """
+        .. image:: example.img
+
+        .. image:: example2.img
+           :width: 50%
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        (app.srcdir / 'example2.img').write_text('image')
+        add_image_type(app, 'name', '.img', PNGImageConverter)
+        app.config.imagehelper_image_dimensions = True
+        on_builder_inited(app)
+        app.build()
+
+        entry = get_manifest(app.env).entries[os.path.join(app.outdir, '_images', 'example.png')]
+        self.assertEqual((300, 200, (144, 144)), entry.dimensions)
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+            self.assertIn('<img width="300" height="200" style="height: auto;" '
+                          'alt="_images/example.png" src="_images/example.png" />', html)
+            self.assertIn('<img alt="_images/example2.png" src="_images/example2.png" style="width: 50%;" />', html)
+
+        # dimensions of unchanged images are taken from the manifest
+        app.env.all_docs.clear()  # force to re-read documents
+        with patch('sphinxcontrib.imagehelper.scheduler.get_image_dimensions') as get_dimensions:
+            app.build()
+            self.assertEqual(0, get_dimensions.call_count)
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertIn('<img width="300" height="200"', fd.read())
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_intrinsic_dimensions_on_node(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', PNGImageConverter)
+        on_builder_inited(app)
+        app.build()
+
+        doctree = app.env.get_and_resolve_doctree('contents', app.builder)
+        image = doctree.traverse(lambda node: 'intrinsic_width' in node)[0]
+        self.assertEqual((300, 200, (144, 144)),
+                         (image['intrinsic_width'], image['intrinsic_height'], image['intrinsic_dpi']))
+
+        # width and height attributes are not emitted by default
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertIn('<img alt="_images/example.png" src="_images/example.png" />', fd.read())
+
+    def test_get_image_dimensions(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'image.png')
+            write_png(path, 640, 480)
+            self.assertEqual((640, 480, None), get_image_dimensions(path))
+
+            write_png(path, 640, 480, dpi=300)
+            self.assertEqual((640, 480, (300, 300)), get_image_dimensions(path))
+
+            path = os.path.join(tmpdir, 'image.svg')
+            with open(path, 'w') as fd:
+                fd.write('<svg xmlns="http://www.w3.org/2000/svg" width="120" height="80"></svg>')
+            self.assertEqual((120, 80, None), get_image_dimensions(path))
+
+            self.assertIsNone(get_image_dimensions(os.path.join(tmpdir, 'unknown.png')))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+from time import time
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class BrokenImageConverter(ImageConverter):
+    converted = []
+
+    def get_filename_for(self, node):
+        return 'converted.png'
+
+    def convert(self, node, filename, to):
+        self.converted.append(node['uri'])
+        return False
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        BrokenImageConverter.converted = []
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_negative_cache(self, app, status, warnings):
+        """
+        .. image:: broken.img
+        """
+        (app.srcdir / 'broken.img').write_text('')
+        add_image_type(app, 'name', '.img', BrokenImageConverter)
+        on_builder_inited(app)
+        app.build()
+        self.assertEqual(['broken.img'], BrokenImageConverter.converted)
+
+        # failed conversion is skipped with warning
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        self.assertEqual(['broken.img'], BrokenImageConverter.converted)
+        self.assertIn('Skip converting broken.img; it failed in the previous build', warnings.getvalue())
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertNotIn('<img', fd.read())
+
+        # the negative cache is kept in the environment
+        app.env.all_docs.clear()
+        app.build()
+        self.assertEqual(['broken.img'], BrokenImageConverter.converted)
+
+        # converted again if the source has changed
+        timestamp = time() + 10
+        os.utime(app.srcdir / 'broken.img', (timestamp, timestamp))
+        app.env.all_docs.clear()
+        app.build()
+        self.assertEqual(['broken.img', 'broken.img'], BrokenImageConverter.converted)
+
+        # converted again if the converter has changed
+        BrokenImageConverter.version = '2.0'
+        try:
+            app.env.all_docs.clear()
+            app.build()
+            self.assertEqual(['broken.img'] * 3, BrokenImageConverter.converted)
+        finally:
+            BrokenImageConverter.version = ''
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_retry_failed(self, app, status, warnings):
+        """
+        .. image:: broken.img
+        """
+        (app.srcdir / 'broken.img').write_text('')
+        add_image_type(app, 'name', '.img', BrokenImageConverter)
+        on_builder_inited(app)
+        app.build()
+
+        app.config.imagehelper_retry_failed = True
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        self.assertEqual(['broken.img', 'broken.img'], BrokenImageConverter.converted)
+        self.assertNotIn('Skip converting', warnings.getvalue())
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import mock
+from shutil import copyfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.fetch import RemoteFetcher
+
+try:
+    from socketserver import ThreadingMixIn
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2.x
+    from SocketServer import ThreadingMixIn
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+LAST_MODIFIED = 'Sun, 01 Jan 2017 00:00:00 GMT'
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.clients.add(self.client_address)
+
+        if self.path == '/moved.img':
+            self.send_response(301)
+            self.send_header('Location', '/example.img')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path not in self.server.images:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            body = self.server.images[self.path]
+            etag = '"%d"' % len(body)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', LAST_MODIFIED)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RemoteImageConverter(ImageConverter):
+    fetch_remote_images = True
+
+    def get_filename_for(self, node):
+        return os.path.basename(node['uri']).replace('.img', '.png')
+
+    def convert(self, node, filename, to):
+        copyfile(filename, to)
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = ImageServer(('127.0.0.1', 0), ImageRequestHandler)
+        self.server.images = {'/example.img': b'image', '/another.img': b'another image'}
+        self.server.requests = []
+        self.server.clients = set()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.baseurl = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_remote_fetcher(self):
+        warnings = []
+        fetcher = RemoteFetcher(self.tmpdir, connections=1, timeout=5, warn=warnings.append)
+        paths = fetcher.fetch_many([self.baseurl + 'example.img', self.baseurl + 'another.img',
+                                    self.baseurl + 'moved.img', self.baseurl + 'unknown.img'])
+        fetcher.close()
+
+        with open(paths[self.baseurl + 'example.img'], 'rb') as fd:
+            self.assertEqual(b'image', fd.read())
+        self.assertEqual(paths[self.baseurl + 'example.img'], fetcher.get_path(self.baseurl + 'example.img'))
+        self.assertTrue(paths[self.baseurl + 'example.img'].endswith('.img'))
+        self.assertEqual(1483228800, os.stat(paths[self.baseurl + 'example.img']).st_mtime)
+        self.assertIsNone(paths[self.baseurl + 'unknown.img'])
+        self.assertEqual(1, len(warnings))
+        self.assertIn('404', warnings[0])
+        self.assertEqual((3, 0, 1), (fetcher.downloads, fetcher.not_modified, fetcher.failures))
+
+        # requests share one keep-alive connection
+        self.assertEqual(1, fetcher.pool.opened)
+        self.assertEqual(1, len(self.server.clients))
+
+        # next fetcher revalidates the cached copies
+        fetcher = RemoteFetcher(self.tmpdir, connections=2, timeout=5)
+        fetcher.fetch_many([self.baseurl + 'example.img', self.baseurl + 'another.img'])
+        fetcher.close()
+        self.assertEqual((0, 2, 0), (fetcher.downloads, fetcher.not_modified, fetcher.failures))
+
+        # cached copy is used if the server is unavailable
+        self.server.images.clear()
+        fetcher = RemoteFetcher(self.tmpdir, connections=1, timeout=5, warn=warnings.append)
+        path = fetcher.fetch(self.baseurl + 'example.img')
+        fetcher.close()
+        self.assertEqual(fetcher.get_path(self.baseurl + 'example.img'), path)
+        self.assertIn('use cached copy', warnings[-1])
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_remote_images_on_build(self, app, status, warnings):
+        (app.srcdir / 'contents.rst').write_text('.. image:: %sexample.img\n\n'
+                                                 '.. image:: %sanother.img\n' % (self.baseurl, self.baseurl))
+        add_image_type(app, 'name', self.baseurl, RemoteImageConverter)
+        app.config.imagehelper_metrics_file = 'metrics.json'
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+            self.assertIn('src="_images/example.png"', html)
+            self.assertIn('src="_images/another.png"', html)
+        with open(app.outdir / '_images' / 'example.png', 'rb') as fd:
+            self.assertEqual(b'image', fd.read())
+        with open(app.outdir / 'metrics.json') as fd:
+            metrics = json.load(fd)
+            self.assertEqual(2, metrics['remote']['downloads'])
+            self.assertEqual(2, metrics['total']['conversions'])
+
+        # unchanged remote images are neither downloaded nor converted again
+        on_builder_inited(app)
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        with open(app.outdir / 'metrics.json') as fd:
+            metrics = json.load(fd)
+            self.assertEqual(0, metrics['remote']['downloads'])
+            self.assertEqual(2, metrics['remote']['not_modified'])
+            self.assertEqual(0, metrics['total']['conversions'])
+            self.assertEqual(2, metrics['total']['cache_hits'])
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_remote_images_across_documents(self, app, status, warnings):
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   sub1\n   sub2\n')
+        (app.srcdir / 'sub1.rst').write_text('sub1\n====\n\n.. image:: %sexample.img\n' % self.baseurl)
+        (app.srcdir / 'sub2.rst').write_text('sub2\n====\n\n.. image:: %sanother.img\n' % self.baseurl)
+        add_image_type(app, 'name', self.baseurl, RemoteImageConverter)
+        on_builder_inited(app)
+
+        fetched = []
+        fetch_many = RemoteFetcher.fetch_many
+        with mock.patch.object(RemoteFetcher, 'fetch_many', autospec=True,
+                               side_effect=lambda self, urls: fetched.append(sorted(urls)) or fetch_many(self, urls)):
+            app.build()
+
+        # the remote images of all documents are fetched at once
+        self.assertEqual([[self.baseurl + 'another.img', self.baseurl + 'example.img']], fetched)
+        with open(app.outdir / 'sub2.html') as fd:
+            self.assertIn('src="_images/another.png"', fd.read())
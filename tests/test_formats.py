@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from sphinx_testing import with_app
+from sphinx.application import Sphinx
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.manifest import get_manifest
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class MultiFormatImageConverter(ImageConverter):
+    output_formats = ('.svg', '.pdf', '.png')
+    converted = []
+
+    def convert(self, node, filename, to):
+        ext = os.path.splitext(to)[1]
+        self.converted.append(ext)
+        with open(to, 'w') as fd:
+            fd.write(ext)
+        return True
+
+
+def load_metrics(app):
+    with open(os.path.join(app.outdir, 'metrics.json')) as fd:
+        return json.load(fd)
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        MultiFormatImageConverter.converted = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_output_formats(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', MultiFormatImageConverter)
+        on_builder_inited(app)
+        app.build()
+
+        # formats supported by the builder are converted (without cache)
+        self.assertEqual(['.svg', '.png'], MultiFormatImageConverter.converted)
+        self.assertTrue((app.outdir / '_images' / 'example.svg').exists())
+        self.assertTrue((app.outdir / '_images' / 'example.png').exists())
+        self.assertFalse((app.outdir / '_images' / 'example.pdf').exists())
+
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertIn('src="_images/example.svg"', fd.read())
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_output_formats_shared_between_builders(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', MultiFormatImageConverter)
+        app.config.imagehelper_cache_dir = os.path.join(self.tmpdir, 'cache')
+        app.config.imagehelper_metrics_file = 'metrics.json'
+        on_builder_inited(app)
+        app.build()
+
+        self.assertEqual(['.svg', '.pdf', '.png'], MultiFormatImageConverter.converted)
+        self.assertFalse((app.outdir / '_images' / 'example.pdf').exists())
+        self.assertEqual(3, load_metrics(app)['total']['conversions'])
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertIn('src="_images/example.svg"', fd.read())
+
+        # the formats only for the cache are not kept in the doctree directory
+        formatsdir = app.doctreedir / 'imagehelper_formats'
+        self.assertEqual([], os.listdir(formatsdir) if os.path.exists(formatsdir) else [])
+        self.assertNotIn(formatsdir / 'example.pdf', get_manifest(app.env))
+
+        # and they are not converted again while they are in the cache
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        self.assertEqual(['.svg', '.pdf', '.png'], MultiFormatImageConverter.converted)
+        self.assertEqual(3, load_metrics(app)['total']['cache_hits'])
+        self.assertEqual([], os.listdir(formatsdir) if os.path.exists(formatsdir) else [])
+
+        # LaTeX builder picks PDF from the cache without conversion
+        latex = Sphinx(app.srcdir, app.srcdir, os.path.join(self.tmpdir, 'latex'),
+                       os.path.join(self.tmpdir, 'doctrees'), 'latex', status=None)
+        add_image_type(latex, 'name', '.img', MultiFormatImageConverter)
+        latex.config.imagehelper_cache_dir = os.path.join(self.tmpdir, 'cache')
+        latex.config.imagehelper_metrics_file = 'metrics.json'
+        on_builder_inited(latex)
+        latex.build()
+
+        self.assertEqual(['.svg', '.pdf', '.png'], MultiFormatImageConverter.converted)
+        metrics = load_metrics(latex)
+        self.assertEqual(0, metrics['total']['conversions'])
+        self.assertEqual(3, metrics['total']['cache_hits'])
+        with open(os.path.join(self.tmpdir, 'latex', 'example.pdf')) as fd:
+            self.assertEqual('.pdf', fd.read())
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'latex', 'example.svg')))
+        with open(os.path.join(self.tmpdir, 'latex', 'Python.tex')) as fd:
+            self.assertIn('{{example}.pdf}', fd.read())
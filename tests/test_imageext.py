@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import mock
 import pickle
 from time import time
 from docutils import nodes
@@ -8,8 +10,9 @@ from shutil import copyfile
 from sphinx_testing import with_app
 from sphinx_testing.path import path
 from docutils.parsers.rst import directives
-from sphinxcontrib.imagehelper import add_image_type, ImageConverter
-from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper import add_image_directive, add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited, parse_options, ImageTypeRegistry
+from sphinxcontrib.imagehelper.scheduler import ConversionScheduler
 
 if sys.version_info < (2, 7):
     import unittest2 as unittest
@@ -139,7 +142,9 @@ class TestSphinxcontrib(unittest.TestCase):
         class TestImageConverter(MyImageConverter):
             def convert(_self, node, filename, to):
                 self.assertEqual(_self.app.srcdir / 'subdir' / 'example.img', filename)
-                self.assertEqual(_self.app.outdir / '_images' / 'converted.png', to)
+                # converted image is written to temporary file, and renamed after conversion
+                self.assertEqual(_self.app.outdir / '_images', os.path.dirname(to))
+                self.assertTrue(to.endswith('converted.png'))
                 return super(TestImageConverter, _self).convert(node, filename, to)
 
         (app.srcdir / 'subdir').makedirs()
@@ -229,3 +234,90 @@ class TestSphinxcontrib(unittest.TestCase):
 
         html = (app.builddir / 'html' / 'contents.html').read_text()
         self.assertRegexpMatches(html, '<div class="body"[^>]*>\s*</div>')
+
+    @with_app(buildername='html', create_new_srcdir=True, parallel=2)
+    def test_add_image_type_on_parallel_build(self, app, status, warnings):
+        docnames = ['doc%d' % i for i in range(8)]
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   ' + '\n   '.join(docnames))
+        for docname in docnames:
+            (app.srcdir / (docname + '.rst')).write_text('%s\n====\n\n.. image:: example.img\n' % docname)
+        (app.srcdir / 'example.img').write_text('')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        on_builder_inited(app)
+        app.build()
+
+        self.assertTrue(app.is_parallel_allowed('read'))
+        self.assertTrue(app.is_parallel_allowed('write'))
+        self.assertEqual(set(docnames), set(app.env.imagehelper_images))
+        self.assertEqual(set(['example.img']), app.env.imagehelper_images['doc0'])
+        for docname in docnames:
+            with open(app.outdir / (docname + '.html')) as fd:
+                self.assertIn('src="_images/converted.png"', fd.read())
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_skip_documents_without_images(self, app, status, warnings):
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   doc1\n   doc2\n')
+        (app.srcdir / 'doc1.rst').write_text('doc1\n====\n\n.. image:: example.img\n')
+        (app.srcdir / 'doc2.rst').write_text('doc2\n====\n\n.. image:: example.png\n')
+        (app.srcdir / 'example.img').write_text('')
+        (app.srcdir / 'example.png').write_text('')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        on_builder_inited(app)
+        with mock.patch.object(ConversionScheduler, 'flush', autospec=True,
+                               side_effect=ConversionScheduler.flush) as flush:
+            app.build()
+
+        self.assertEqual(['doc1'], list(app.env.imagehelper_images))
+        # doc2 is skipped on resolving
+        self.assertEqual(1, flush.call_count)
+        with open(app.outdir / 'doc1.html') as fd:
+            self.assertIn('src="_images/converted.png"', fd.read())
+
+    @with_app(buildername='latex', create_new_srcdir=True)
+    def test_images_in_assembled_doctree(self, app, status, warnings):
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   chap\n')
+        (app.srcdir / 'chap.rst').write_text('chap\n====\n\n.. image:: example.img\n\n.. x-image:: example.img\n')
+        (app.srcdir / 'example.img').write_text('')
+        add_image_type(app, 'x', '.img', MyImageConverter)
+        add_image_directive(app, 'x')
+        on_builder_inited(app)
+        app.build()
+
+        # the images of the inlined documents are converted in the doctree of the master document
+        with open(app.outdir / 'Python.tex') as fd:
+            self.assertEqual(2, fd.read().count('\\sphinxincludegraphics{{converted}.png}'))
+
+    def test_parse_options(self):
+        options = parse_options('foo=1&bar=abc&bar=def')
+        self.assertEqual({'foo': ['1'], 'bar': ['abc', 'def']}, options)
+        self.assertIs(options, parse_options('foo=1&bar=abc&bar=def'))
+        self.assertEqual({}, parse_options(''))
+
+    def test_image_type_registry(self):
+        class AnotherImageConverter(MyImageConverter):
+            pass
+
+        class DiagramConverter(MyImageConverter):
+            pass
+
+        registry = ImageTypeRegistry()
+        registry.add('name', '.img', MyImageConverter)
+        registry.add('another', 'imgx', AnotherImageConverter)
+        registry.add('remote', 'http://example.com/', MyImageConverter)
+        registry.add('diagram', 'http://example.com/diagrams/', DiagramConverter)
+
+        self.assertIs(MyImageConverter, registry.get_handler('example.img'))
+        self.assertIs(MyImageConverter, registry.get_handler('subdir/EXAMPLE.IMG'))
+        self.assertIs(AnotherImageConverter, registry.get_handler('example.imgx'))
+        self.assertIsNone(registry.get_handler('example.png'))
+
+        # longest prefix wins
+        self.assertIs(MyImageConverter, registry.get_handler('http://example.com/example'))
+        self.assertIs(DiagramConverter, registry.get_handler('http://example.com/diagrams/example'))
+        self.assertIsNone(registry.get_handler('http://example.org/diagrams/example'))
+        self.assertIsNone(registry.get_handler('see http://example.com/'))
+
+        self.assertIs(MyImageConverter, registry.get_handler_by_name('name'))
+        self.assertIs(AnotherImageConverter, registry.get_handler_by_name('another'))
+        self.assertIs(DiagramConverter, registry.get_handler_by_name('diagram'))
+        self.assertIsNone(registry.get_handler_by_name('unknown'))
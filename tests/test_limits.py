@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+from shutil import copyfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.limits import ConversionTimeout, resource, run_command
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class CommandImageConverter(ImageConverter):
+    timeout = 0.5
+
+    def get_filename_for(self, node):
+        return node['uri'].replace('.img', '.png')
+
+    def convert(self, node, filename, to):
+        if node['uri'].startswith('hang'):
+            script = 'import time; time.sleep(10)'
+        else:
+            script = 'import shutil, sys; shutil.copyfile(sys.argv[1], sys.argv[2])'
+        returncode, _, _ = self.run_command([sys.executable, '-c', script, filename, to])
+        return returncode == 0
+
+
+class RunawayImageConverter(ImageConverter):
+    exited = threading.Event()
+
+    def get_filename_for(self, node):
+        return node['uri'].replace('.img', '.png')
+
+    def convert(self, node, filename, to):
+        if node['uri'].startswith('hang'):
+            time.sleep(3)  # can't be interrupted in worker threads
+            copyfile(filename, to)
+            self.exited.set()
+        else:
+            copyfile(filename, to)
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def test_run_command(self):
+        returncode, stdout, _ = run_command([sys.executable, '-c', 'print("hello")'], timeout=5)
+        self.assertEqual(0, returncode)
+        self.assertEqual(b'hello', stdout.strip())
+
+        started = time.time()
+        with self.assertRaises(ConversionTimeout):
+            run_command([sys.executable, '-c', 'import time; time.sleep(10)'], timeout=0.5)
+        self.assertLess(time.time() - started, 5)
+
+    @unittest.skipIf(resource is None, 'resource module is not available')
+    def test_run_command_with_memory_limit(self):
+        script = 'x = bytearray(512 * 1024 * 1024)'
+        returncode, _, stderr = run_command([sys.executable, '-c', script], memory_limit=256 * 1024 * 1024)
+        self.assertNotEqual(0, returncode)
+        self.assertIn(b'MemoryError', stderr)
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_timeout_on_command(self, app, status, warnings):
+        """
+        .. image:: hang.img
+        .. image:: example.img
+        """
+        (app.srcdir / 'hang.img').write_text('')
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', CommandImageConverter)
+        app.config.imagehelper_metrics_file = 'metrics.json'
+        on_builder_inited(app)
+
+        started = time.time()
+        app.build()
+        self.assertLess(time.time() - started, 5)
+
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+        self.assertNotIn('hang', html)
+        self.assertIn('src="_images/example.png"', html)
+        self.assertIn('Conversion of hang.img timed out after 0.5 seconds', warnings.getvalue())
+        with open(app.outdir / 'metrics.json') as fd:
+            self.assertEqual(1, json.load(fd)['total']['failures'])
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_timeout_on_process_pool(self, app, status, warnings):
+        """
+        .. image:: hang.img
+        .. image:: example.img
+        """
+        (app.srcdir / 'hang.img').write_text('')
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', RunawayImageConverter)
+        app.config.imagehelper_conversion_pool = 'process'
+        app.config.imagehelper_conversion_workers = 2
+        app.config.imagehelper_conversion_timeout = 0.5
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+        self.assertNotIn('hang', html)
+        self.assertIn('src="_images/example.png"', html)
+        self.assertIn('Conversion of hang.img timed out after 0.5 seconds', warnings.getvalue())
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_watchdog(self, app, status, warnings):
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   doc1\n   doc2\n')
+        (app.srcdir / 'doc1.rst').write_text('doc1\n====\n\n.. image:: hang.img\n')
+        (app.srcdir / 'doc2.rst').write_text('doc2\n====\n\n.. image:: example.img\n')
+        (app.srcdir / 'hang.img').write_text('')
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', RunawayImageConverter)
+        app.config.imagehelper_conversion_timeout = 0.2
+        on_builder_inited(app)
+        RunawayImageConverter.exited.clear()
+
+        started = time.time()
+        app.build()
+        self.assertLess(time.time() - started, 3)
+
+        # the stalled pool is replaced; following conversions are not affected
+        self.assertIn('Conversion of hang.img timed out after 0.2 seconds', warnings.getvalue())
+        with open(app.outdir / 'doc2.html') as fd:
+            self.assertIn('src="_images/example.png"', fd.read())
+
+        # the abandoned conversion removes its output when it exits at last
+        self.assertTrue(RunawayImageConverter.exited.wait(5))
+        time.sleep(0.5)
+        self.assertEqual(['example.png'], os.listdir(app.outdir / '_images'))
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_timeout_on_queued_conversions(self, app, status, warnings):
+        """
+        .. image:: hang.img
+        .. image:: example.img
+        """
+        (app.srcdir / 'hang.img').write_text('')
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', RunawayImageConverter)
+        app.config.imagehelper_conversion_timeout = 0.3
+        on_builder_inited(app)
+        app.build()
+
+        # the deadline of the queued conversion starts when it is picked up
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+        self.assertNotIn('hang', html)
+        self.assertIn('src="_images/example.png"', html)
+        self.assertIn('Conversion of hang.img timed out after 0.3 seconds', warnings.getvalue())
+        self.assertNotIn('Conversion of example.img timed out', warnings.getvalue())
+
+        # only the stalled conversion is remembered as failed
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        self.assertIn('Skip converting hang.img', warnings.getvalue())
+        self.assertNotIn('Skip converting example.img', warnings.getvalue())
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertIn('src="_images/example.png"', fd.read())
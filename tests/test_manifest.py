@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mock
+import pickle
+from shutil import copyfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.manifest import ConversionManifest
+from sphinxcontrib.imagehelper.scheduler import ConversionJob
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class MyImageConverter(ImageConverter):
+    version = '1.0'
+
+    def get_filename_for(self, node):
+        return node['uri'].replace('.img', '.png')
+
+    def convert(self, node, filename, to):
+        copyfile(filename, to)
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_manifest(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        on_builder_inited(app)
+        app.build()
+
+        path = os.path.normpath(app.outdir / '_images' / 'example.png')
+        entry = app.env.imagehelper_manifest.entries[path]
+        self.assertEqual(os.path.normpath(app.srcdir / 'example.img'), entry.source)
+        self.assertEqual('test_manifest.MyImageConverter', entry.converter)
+        self.assertEqual('1.0', entry.version)
+        self.assertEqual(5, entry.size)
+        self.assertIsNotNone(entry.duration)
+        self.assertEqual(set(['contents']), entry.docnames)
+
+        # the manifest is saved to its own file; the environment is not pickled again
+        with open(app.doctreedir / 'imagehelper_manifest.pickle', 'rb') as fd:
+            self.assertEqual(set([path]), set(pickle.load(fd)['entries']))
+        with open(app.doctreedir / 'environment.pickle', 'rb') as fd:
+            self.assertEqual({}, pickle.load(fd).imagehelper_manifest.entries)
+
+        # and loaded at builder-inited
+        app.env.imagehelper_manifest = ConversionManifest()
+        on_builder_inited(app)
+        self.assertEqual(set(['contents']), app.env.imagehelper_manifest.entries[path].docnames)
+
+        # up-to-date images are decided without stat-ing outputs
+        app.env.all_docs.clear()  # force to re-read documents
+        with mock.patch.object(ConversionJob, 'is_outdated', side_effect=AssertionError):
+            app.build()
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertIn('src="_images/example.png"', fd.read())
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_manifest_on_images_removed(self, app, status, warnings):
+        """
+        .. image:: example.img
+
+        .. image:: another.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        (app.srcdir / 'another.img').write_text('image')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        on_builder_inited(app)
+        app.build()
+        self.assertEqual(['another.png', 'example.png'], sorted((app.outdir / '_images').listdir()))
+
+        # stale outputs are removed at the end of build
+        (app.srcdir / 'contents.rst').write_text('.. image:: example.img\n')
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        self.assertEqual(['example.png'], (app.outdir / '_images').listdir())
+        self.assertIn('imagehelper: removed 1 stale images', status.getvalue())
+
+        # removed outputs are converted again
+        (app.outdir / '_images').rmtree()
+        on_builder_inited(app)
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        self.assertEqual(['example.png'], (app.outdir / '_images').listdir())
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_manifest_on_output_removed(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        on_builder_inited(app)
+        app.build()
+
+        # the removed output is converted again even if the manifest knows it
+        os.remove(app.outdir / '_images' / 'example.png')
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        self.assertEqual(['example.png'], (app.outdir / '_images').listdir())
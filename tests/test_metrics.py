@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+from shutil import copyfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.metrics import ConversionMetrics
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class MyImageConverter(ImageConverter):
+    def get_filename_for(self, node):
+        return node['uri'].replace('.img', '.png')
+
+    def convert(self, node, filename, to):
+        if 'broken' in filename:
+            return False
+
+        copyfile(filename, to)
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_metrics(self, app, status, warnings):
+        """
+        .. image:: example.img
+        .. image:: broken.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        (app.srcdir / 'broken.img').write_text('')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        app.config.imagehelper_metrics_file = 'metrics.json'
+        on_builder_inited(app)
+
+        # first build
+        app.build()
+        self.assertIn('imagehelper: 2 conversions, 0 cache hits, 1 failures, 5 bytes written', status.getvalue())
+        with open(app.outdir / 'metrics.json') as fd:
+            metrics = json.load(fd)
+        self.assertEqual(2, metrics['total']['conversions'])
+        self.assertEqual(1, metrics['total']['failures'])
+        self.assertEqual(5, metrics['total']['bytes_written'])
+        self.assertEqual(1, metrics['sources']['example.img']['conversions'])
+        self.assertEqual(1, metrics['sources']['broken.img']['failures'])
+        self.assertEqual(2, metrics['converters']['test_metrics.MyImageConverter']['conversions'])
+        self.assertEqual(1, metrics['hooks']['doctree-read']['calls'])
+        self.assertEqual(1, metrics['hooks']['doctree-resolved']['calls'])
+
+        # second build (document has changed)
+        status.truncate(0)
+        (app.srcdir / 'contents.rst').utime((time.time() + 1, time.time() + 1))
+        app.build()
+        # broken.img is not converted again; it failed in the previous build
+        self.assertIn('imagehelper: 0 conversions, 1 cache hits, 1 failures, 0 bytes written', status.getvalue())
+
+    def test_summarize(self):
+        metrics = ConversionMetrics()
+        metrics.record('Converter', 'example.img', conversions=1, bytes_written=10, wall=1.5, cpu=0.5)
+        metrics.record('Converter', 'example.img', cache_hits=1)
+        metrics.record_hook('doctree-resolved', 2.0)
+
+        self.assertEqual(['imagehelper: 1 conversions, 1 cache hits, 0 failures, 10 bytes written, '
+                          '1.50s wall, 0.50s cpu',
+                          '    Converter: 1 conversions, 1 cache hits, 0 failures, 10 bytes written, '
+                          '1.50s wall, 0.50s cpu',
+                          '    doctree-resolved: 1 calls, 2.00s'],
+                         metrics.summarize())
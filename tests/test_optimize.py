@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import zlib
+import shutil
+import struct
+import tempfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.optimize import ImageOptimizer, PNGOptimizer, SVGOptimizer
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+def write_chunk(fd, chunk_type, body):
+    fd.write(struct.pack('>I', len(body)) + chunk_type + body)
+    fd.write(struct.pack('>I', zlib.crc32(chunk_type + body) & 0xffffffff))
+
+
+def write_png(path, width=64, height=64):
+    # grayscale image without compression
+    raw = b''.join(b'\x00' + bytes(bytearray([(x + y) % 4 for x in range(width)])) for y in range(height))
+    with open(path, 'wb') as fd:
+        fd.write(b'\x89PNG\r\n\x1a\n')
+        write_chunk(fd, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+        write_chunk(fd, b'IDAT', zlib.compress(raw, 0)[:100])
+        write_chunk(fd, b'IDAT', zlib.compress(raw, 0)[100:])
+        write_chunk(fd, b'IEND', b'')
+
+    return raw
+
+
+def read_png(path):
+    with open(path, 'rb') as fd:
+        data = fd.read()
+
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(chunk_type + body) & 0xffffffff
+        chunks.append((chunk_type, body))
+        pos += 12 + length
+
+    idat = b''.join(body for chunk_type, body in chunks if chunk_type == b'IDAT')
+    return [chunk_type for chunk_type, _ in chunks], zlib.decompress(idat)
+
+
+class PNGImageConverter(ImageConverter):
+    def convert(self, node, filename, to):
+        write_png(to)
+        return True
+
+
+class CountingOptimizer(PNGOptimizer):
+    optimized = []
+
+    def optimize(self, filename, to):
+        self.optimized.append(filename)
+        return super(CountingOptimizer, self).optimize(filename, to)
+
+
+class BrokenOptimizer(ImageOptimizer):
+    extensions = ('.png',)
+
+    def optimize(self, filename, to):
+        raise IOError('broken')
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        CountingOptimizer.optimized = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_png_optimizer(self):
+        source = os.path.join(self.tmpdir, 'source.png')
+        optimized = os.path.join(self.tmpdir, 'optimized.png')
+        raw = write_png(source)
+
+        self.assertTrue(PNGOptimizer().optimize(source, optimized))
+        self.assertLess(os.path.getsize(optimized), os.path.getsize(source))
+        self.assertEqual(([b'IHDR', b'IDAT', b'IEND'], raw), read_png(optimized))
+
+        # not a PNG image
+        with open(source, 'w') as fd:
+            fd.write('<svg/>')
+        self.assertFalse(PNGOptimizer().optimize(source, optimized))
+
+    def test_svg_optimizer(self):
+        source = os.path.join(self.tmpdir, 'source.svg')
+        optimized = os.path.join(self.tmpdir, 'optimized.svg')
+        with open(source, 'w') as fd:
+            fd.write('<?xml version="1.0"?>\n'
+                     '<!-- generated by tool -->\n'
+                     '<svg xmlns="http://www.w3.org/2000/svg">\n'
+                     '  <text>Hello <tspan>world</tspan></text>\n'
+                     '</svg>\n')
+
+        self.assertTrue(SVGOptimizer().optimize(source, optimized))
+        with open(optimized) as fd:
+            self.assertEqual('<?xml version="1.0"?><svg xmlns="http://www.w3.org/2000/svg">'
+                             '<text>Hello <tspan>world</tspan></text></svg>', fd.read())
+
+        # whitespace in text and under xml:space="preserve" is kept
+        with open(source, 'w') as fd:
+            fd.write('<svg xmlns="http://www.w3.org/2000/svg">\n'
+                     '  <text>\n    <tspan>a</tspan>\n    <tspan>b</tspan>\n  </text>\n'
+                     '  <g xml:space="preserve">\n    <title>  title  </title>\n  </g>\n'
+                     '</svg>\n')
+
+        self.assertTrue(SVGOptimizer().optimize(source, optimized))
+        with open(optimized) as fd:
+            self.assertEqual('<svg xmlns="http://www.w3.org/2000/svg">'
+                             '<text>\n    <tspan>a</tspan>\n    <tspan>b</tspan>\n  </text>'
+                             '<g xml:space="preserve">\n    <title>  title  </title>\n  </g></svg>', fd.read())
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_optimizers(self, app, status, warnings):
+        """
+        .. image:: example1.img
+        .. image:: example2.img
+        """
+        (app.srcdir / 'example1.img').write_text('image1')
+        (app.srcdir / 'example2.img').write_text('image2')
+        add_image_type(app, 'name', '.img', PNGImageConverter)
+        app.config.imagehelper_optimizers = [CountingOptimizer]
+        app.config.imagehelper_metrics_file = 'metrics.json'
+        on_builder_inited(app)
+        app.build()
+
+        # same artifacts are optimized only once
+        self.assertEqual(1, len(CountingOptimizer.optimized))
+        raw = write_png(os.path.join(self.tmpdir, 'expected.png'))
+        for name in ('example1.png', 'example2.png'):
+            self.assertEqual(raw, read_png(app.outdir / '_images' / name)[1])
+
+        original_size = os.path.getsize(os.path.join(self.tmpdir, 'expected.png'))
+        optimized_size = os.path.getsize(app.outdir / '_images' / 'example1.png')
+        with open(app.outdir / 'metrics.json') as fd:
+            metrics = json.load(fd)
+            self.assertEqual((original_size - optimized_size) * 2, metrics['total']['bytes_saved'])
+            self.assertEqual(original_size - optimized_size, metrics['sources']['example1.img']['bytes_saved'])
+            self.assertEqual(optimized_size * 2, metrics['total']['bytes_written'])
+        self.assertIn('%d bytes saved by optimization' % metrics['total']['bytes_saved'], status.getvalue())
+
+        # optimized artifacts are cached by their hash
+        (app.srcdir / 'example1.img').write_text('modified')
+        app.build()
+        self.assertEqual(1, len(CountingOptimizer.optimized))
+        self.assertEqual(optimized_size, os.path.getsize(app.outdir / '_images' / 'example1.png'))
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_broken_optimizer(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', PNGImageConverter)
+        app.config.imagehelper_optimizers = ['svg', BrokenOptimizer, 'unknown']
+        on_builder_inited(app)
+        app.build()
+
+        # the image is kept as converted
+        self.assertIn('Unknown optimizer in imagehelper_optimizers: unknown', warnings.getvalue())
+        self.assertIn('Fail to optimize example.img: broken', warnings.getvalue())
+        self.assertEqual(write_png(os.path.join(self.tmpdir, 'expected.png')),
+                         read_png(app.outdir / '_images' / 'example.png')[1])
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from sphinx_testing import with_app
+from sphinx.application import Sphinx
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.preconvert import find_images, main
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+CONF_PY = '''
+import os
+from shutil import copyfile
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+
+master_doc = 'index'
+imagehelper_metrics_file = 'metrics.json'
+
+
+class CopyImageConverter(ImageConverter):
+    def get_filename_for(self, node):
+        return os.path.splitext(os.path.basename(node['uri']))[0] + '.png'
+
+    def convert(self, node, filename, to):
+        copyfile(filename, to)
+        return True
+
+
+def setup(app):
+    add_image_type(app, 'name', 'img', CopyImageConverter)
+'''
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @with_app(buildername='html', create_new_srcdir=True, confoverrides={'exclude_patterns': ['excluded']})
+    def test_find_images(self, app, status, warnings):
+        (app.srcdir / 'contents.rst').write_text('.. image:: sub/example.img\n\n'
+                                                 '.. image:: http://example.com/remote.img\n\n'
+                                                 'see http://example.com/images/diagram.img.\n')
+        (app.srcdir / 'example.img').write_text('')
+        (app.srcdir / 'example.png').write_text('')
+        (app.srcdir / 'sub').makedirs()
+        (app.srcdir / 'sub' / 'example.img').write_text('')
+        (app.srcdir / 'excluded').makedirs()
+        (app.srcdir / 'excluded' / 'example.img').write_text('')
+        (app.outdir / '_images').makedirs()
+        (app.outdir / '_images' / 'example.img').write_text('')
+        add_image_type(app, 'name', '.img', ImageConverter)
+
+        self.assertEqual(['example.img', 'sub/example.img'], find_images(app))
+
+        add_image_type(app, 'name', 'http://example.com/', ImageConverter)
+        self.assertEqual(['example.img',
+                          'http://example.com/images/diagram.img',
+                          'http://example.com/remote.img',
+                          'sub/example.img'], find_images(app))
+
+    def test_preconvert(self):
+        srcdir = os.path.join(self.tmpdir, 'src')
+        outdir = os.path.join(self.tmpdir, 'html')
+        doctreedir = os.path.join(self.tmpdir, 'doctrees')
+        os.makedirs(os.path.join(srcdir, 'sub'))
+        with open(os.path.join(srcdir, 'conf.py'), 'w') as fd:
+            fd.write(CONF_PY)
+        with open(os.path.join(srcdir, 'index.rst'), 'w') as fd:
+            fd.write('.. toctree::\n\n   sub/index\n')
+        with open(os.path.join(srcdir, 'sub', 'index.rst'), 'w') as fd:
+            fd.write('sub\n===\n\n.. image:: example.img\n')
+        with open(os.path.join(srcdir, 'sub', 'example.img'), 'w') as fd:
+            fd.write('image')
+
+        self.assertEqual(0, main([srcdir, outdir, '-d', doctreedir, '-q', '-j', '2']))
+        with open(os.path.join(outdir, '_images', 'example.png')) as fd:
+            self.assertEqual('image', fd.read())
+        with open(os.path.join(outdir, 'metrics.json')) as fd:
+            self.assertEqual(1, json.load(fd)['total']['conversions'])
+
+        # sphinx-build uses pre-converted images
+        app = Sphinx(srcdir, srcdir, outdir, doctreedir, 'html', status=None)
+        app.build()
+        with open(os.path.join(outdir, 'sub', 'index.html')) as fd:
+            self.assertIn('src="../_images/example.png"', fd.read())
+        with open(os.path.join(outdir, 'metrics.json')) as fd:
+            metrics = json.load(fd)
+            self.assertEqual(0, metrics['total']['conversions'])
+            self.assertEqual(1, metrics['total']['cache_hits'])
+
+    def test_preconvert_without_extension(self):
+        srcdir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(srcdir)
+        with open(os.path.join(srcdir, 'conf.py'), 'w') as fd:
+            fd.write('')
+
+        self.assertEqual(2, main([srcdir, os.path.join(self.tmpdir, 'html'), '-q']))
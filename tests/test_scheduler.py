@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import threading
+from shutil import copyfile
+from sphinx_testing import with_app
+from docutils.parsers.rst import directives
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class CopyingImageConverter(ImageConverter):
+    def get_filename_for(self, node):
+        return node['uri'].replace('.img', '.png')
+
+    def convert(self, node, filename, to):
+        copyfile(filename, to)
+        return True
+
+
+class CountingImageConverter(CopyingImageConverter):
+    option_spec = {
+        'foo': directives.positive_int,
+    }
+    converted = []
+
+    def get_filename_for(self, node):
+        return 'converted-%d.png' % node.get('foo', 1)
+
+    def convert(self, node, filename, to):
+        self.converted.append(to)
+        return super(CountingImageConverter, self).convert(node, filename, to)
+
+
+class BatchImageConverter(CopyingImageConverter):
+    batches = []
+
+    def convert(self, node, filename, to):
+        raise AssertionError('convert() should not be called')
+
+    def convert_many(self, jobs):
+        self.batches.append(len(jobs))
+        results = []
+        for node, filename, to in jobs:
+            if node['uri'].startswith('broken'):
+                results.append(False)
+            else:
+                copyfile(filename, to)
+                results.append(True)
+
+        return results
+
+
+class SlowImageConverter(CopyingImageConverter):
+    def convert(self, node, filename, to):
+        # finish conversions in reverse order
+        time.sleep(0.05 * (5 - int(node['uri'][0])))
+        return super(SlowImageConverter, self).convert(node, filename, to)
+
+
+class ConcurrentImageConverter(CopyingImageConverter):
+    lock = threading.Lock()
+    running = 0
+    concurrency = 0
+
+    def convert(self, node, filename, to):
+        cls = ConcurrentImageConverter
+        with cls.lock:
+            cls.running += 1
+            cls.concurrency = max(cls.concurrency, cls.running)
+        time.sleep(0.3)
+        with cls.lock:
+            cls.running -= 1
+        return super(ConcurrentImageConverter, self).convert(node, filename, to)
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_thread_pool(self, app, status, warnings):
+        """
+        .. image:: 1.img
+        .. image:: 2.img
+        .. image:: 3.img
+        .. image:: 4.img
+        """
+        for i in range(1, 5):
+            (app.srcdir / ('%d.img' % i)).write_text('')
+        add_image_type(app, 'name', '.img', SlowImageConverter)
+        app.config.imagehelper_conversion_workers = 4
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+        positions = [html.index('src="_images/%d.png"' % i) for i in range(1, 5)]
+        self.assertEqual(sorted(positions), positions)
+        for i in range(1, 5):
+            self.assertTrue((app.outdir / '_images' / ('%d.png' % i)).exists())
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_process_pool(self, app, status, warnings):
+        """
+        .. image:: 1.img
+        .. image:: 2.img
+        """
+        for i in range(1, 3):
+            (app.srcdir / ('%d.img' % i)).write_text('')
+        add_image_type(app, 'name', '.img', CopyingImageConverter)
+        app.config.imagehelper_conversion_pool = 'process'
+        app.config.imagehelper_conversion_workers = 2
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+        self.assertIn('<img alt="_images/1.png" src="_images/1.png" />', html)
+        self.assertIn('<img alt="_images/2.png" src="_images/2.png" />', html)
+        self.assertTrue((app.outdir / '_images' / '1.png').exists())
+        self.assertTrue((app.outdir / '_images' / '2.png').exists())
+        self.assertIsNone(app.imageext_scheduler)
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_deduplicate_conversions(self, app, status, warnings):
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   sub1\n   sub2\n')
+        (app.srcdir / 'sub1.rst').write_text('sub1\n====\n\n.. image:: 1.img\n.. image:: 1.img\n')
+        (app.srcdir / 'sub2.rst').write_text('sub2\n====\n\n.. image:: 1.img\n.. image:: 1.img\n   :option: foo=2\n')
+        (app.srcdir / '1.img').write_text('')
+        CountingImageConverter.converted = []
+        add_image_type(app, 'name', '.img', CountingImageConverter)
+        on_builder_inited(app)
+        app.build()
+
+        # converted once for each set of options
+        self.assertEqual(2, len(CountingImageConverter.converted))
+        for html in ('sub1.html', 'sub2.html'):
+            with open(app.outdir / html) as fd:
+                self.assertIn('src="_images/converted-1.png"', fd.read())
+
+        # temporary files are renamed to target
+        self.assertEqual(['converted-1.png', 'converted-2.png'], sorted(os.listdir(app.outdir / '_images')))
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_convert_many(self, app, status, warnings):
+        """
+        .. image:: 1.img
+        .. image:: broken.img
+        .. image:: 2.img
+        """
+        for name in ('1.img', '2.img', 'broken.img'):
+            (app.srcdir / name).write_text('')
+        BatchImageConverter.batches = []
+        add_image_type(app, 'name', '.img', BatchImageConverter)
+        app.config.imagehelper_conversion_workers = 2
+        on_builder_inited(app)
+        app.build()
+
+        self.assertEqual([3], BatchImageConverter.batches)
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+        self.assertIn('src="_images/1.png"', html)
+        self.assertIn('src="_images/2.png"', html)
+        self.assertNotIn('broken', html)
+        self.assertEqual(['1.png', '2.png'], sorted(os.listdir(app.outdir / '_images')))
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_convert_many_across_documents(self, app, status, warnings):
+        docnames = ['doc%d' % i for i in range(4)]
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   ' + '\n   '.join(docnames))
+        for docname in docnames:
+            (app.srcdir / (docname + '.rst')).write_text('%s\n====\n\n.. image:: %s.img\n' % (docname, docname))
+            (app.srcdir / (docname + '.img')).write_text('')
+        BatchImageConverter.batches = []
+        add_image_type(app, 'name', '.img', BatchImageConverter)
+        app.config.imagehelper_conversion_workers = 2
+        on_builder_inited(app)
+        app.build()
+
+        # images in all documents are converted in one batch
+        self.assertEqual([4], BatchImageConverter.batches)
+        for docname in docnames:
+            with open(app.outdir / (docname + '.html')) as fd:
+                self.assertIn('src="_images/%s.png"' % docname, fd.read())
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_thread_pool_across_documents(self, app, status, warnings):
+        docnames = ['doc%d' % i for i in range(8)]
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   ' + '\n   '.join(docnames))
+        for docname in docnames:
+            (app.srcdir / (docname + '.rst')).write_text('%s\n====\n\n.. image:: %s.img\n' % (docname, docname))
+            (app.srcdir / (docname + '.img')).write_text('')
+        ConcurrentImageConverter.concurrency = 0
+        add_image_type(app, 'name', '.img', ConcurrentImageConverter)
+        app.config.imagehelper_conversion_workers = 4
+        on_builder_inited(app)
+        app.build()
+
+        # images in different documents are converted at the same time
+        self.assertEqual(4, ConcurrentImageConverter.concurrency)
+        for docname in docnames:
+            with open(app.outdir / (docname + '.html')) as fd:
+                self.assertIn('src="_images/%s.png"' % docname, fd.read())
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import struct
+import tempfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.srcset import Image
+from sphinxcontrib.imagehelper.dimensions import get_image_dimensions
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+def write_png_header(path, width, height):
+    with open(path, 'wb') as fd:
+        fd.write(b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', width, height))
+
+
+def get_image_size(path):
+    dimensions = get_image_dimensions(path)
+    if dimensions is None:
+        return None
+    else:
+        return dimensions[:2]
+
+
+class ScalableImageConverter(ImageConverter):
+    scaled = []
+
+    def convert(self, node, filename, to):
+        write_png_header(to, 1000, 500)
+        return True
+
+    def scale(self, node, filename, to, width):
+        self.scaled.append(width)
+        size = get_image_size(filename)
+        write_png_header(to, width, size[1] * width // size[0])
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        ScalableImageConverter.scaled = []
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_srcset(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', ScalableImageConverter)
+        app.config.imagehelper_srcset_widths = [480, 960, 2000]
+        app.config.imagehelper_srcset_sizes = '(max-width: 600px) 100vw, 600px'
+        app.config.imagehelper_metrics_file = 'metrics.json'
+        on_builder_inited(app)
+        app.build()
+
+        self.assertEqual([480, 960], ScalableImageConverter.scaled)
+        self.assertEqual((480, 240), get_image_size(app.outdir / '_images' / 'example-480w.png'))
+        self.assertEqual((960, 480), get_image_size(app.outdir / '_images' / 'example-960w.png'))
+        with open(app.outdir / 'contents.html') as fd:
+            html = fd.read()
+            self.assertIn('<img srcset="_images/example-480w.png 480w, _images/example-960w.png 960w, '
+                          '_images/example.png 1000w" sizes="(max-width: 600px) 100vw, 600px" '
+                          'alt="_images/example.png" src="_images/example.png" />', html)
+
+        # variants are kept in next build
+        app.env.all_docs.clear()  # force to re-read documents
+        app.build()
+        self.assertEqual([480, 960], ScalableImageConverter.scaled)
+        with open(app.outdir / 'metrics.json') as fd:
+            self.assertEqual(3, json.load(fd)['total']['cache_hits'])
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertIn('srcset="_images/example-480w.png 480w', fd.read())
+
+    @with_app(buildername='latex', write_docstring=True, create_new_srcdir=True)
+    def test_srcset_on_latex(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', ScalableImageConverter)
+        app.config.imagehelper_srcset_widths = [480]
+        on_builder_inited(app)
+        app.build()
+
+        self.assertEqual([], ScalableImageConverter.scaled)
+
+    @unittest.skipIf(Image is not None, 'Pillow is installed')
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_srcset_without_pillow(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        class PillowImageConverter(ScalableImageConverter):
+            scale = ImageConverter.scale
+
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', PillowImageConverter)
+        app.config.imagehelper_srcset_widths = [480]
+        on_builder_inited(app)
+        app.build()
+
+        self.assertIn('Pillow is required to generate srcset', warnings.getvalue())
+        with open(app.outdir / 'contents.html') as fd:
+            self.assertNotIn('srcset', fd.read())
+
+    def test_get_image_size(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'image.png')
+            write_png_header(path, 640, 480)
+            self.assertEqual((640, 480), get_image_size(path))
+
+            path = os.path.join(tmpdir, 'image.gif')
+            with open(path, 'wb') as fd:
+                fd.write(b'GIF89a' + struct.pack('<HH', 320, 240))
+            self.assertEqual((320, 240), get_image_size(path))
+
+            self.assertIsNone(get_image_size(os.path.join(tmpdir, 'unknown.png')))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from shutil import copyfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, add_image_directive, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.statcache import StatCache
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class MyImageConverter(ImageConverter):
+    def get_filename_for(self, node):
+        return 'converted.png'
+
+    def convert(self, node, filename, to):
+        copyfile(filename, to)
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stat_cache(self):
+        path = os.path.join(self.tmpdir, 'example.img')
+        statcache = StatCache()
+
+        self.assertFalse(statcache.exists(path))
+        self.assertIsNone(statcache.stat(path))
+        self.assertFalse(statcache.is_readable(path))
+        self.assertEqual((1, 2), (statcache.hits, statcache.misses))
+
+        # cached result is used until invalidated
+        with open(path, 'w') as fd:
+            fd.write('image')
+        self.assertFalse(statcache.exists(path))
+        self.assertFalse(statcache.is_readable(path))
+
+        statcache.invalidate(path)
+        self.assertTrue(statcache.exists(path))
+        self.assertEqual(5, statcache.stat(path).st_size)
+        self.assertTrue(statcache.is_readable(path))
+        self.assertEqual((4, 4), (statcache.hits, statcache.misses))
+        self.assertEqual(0.5, statcache.hit_rate())
+
+    @with_app(buildername='html', create_new_srcdir=True)
+    def test_stat_cache_on_build(self, app, status, warnings):
+        docnames = ['doc%d' % i for i in range(3)]
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   ' + '\n   '.join(docnames))
+        for docname in docnames:
+            (app.srcdir / (docname + '.rst')).write_text('%s\n====\n\n.. name-image:: example.img\n' % docname)
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        add_image_directive(app, 'name')
+        app.config.imagehelper_metrics_file = 'metrics.json'
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'metrics.json') as fd:
+            metrics = json.load(fd)
+
+        # the source is checked once by directives, and stat-ed once by converter
+        self.assertEqual(2, metrics['stat_cache']['hits'])
+        self.assertEqual(5, metrics['total']['bytes_written'])
+        self.assertIn('stat cache: 2 hits', status.getvalue())
+        self.assertIsNone(app.imageext_statcache)
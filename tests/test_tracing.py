@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+from shutil import copyfile
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, add_image_directive, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.tracing import NULL_TRACER, get_tracer
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+class MyImageConverter(ImageConverter):
+    def get_filename_for(self, node):
+        return 'converted.png'
+
+    def convert(self, node, filename, to):
+        copyfile(filename, to)
+        return True
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_trace_file(self, app, status, warnings):
+        """
+        .. image:: example.img
+
+        .. name-image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        add_image_directive(app, 'name')
+        app.config.imagehelper_trace_file = 'trace.json'
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'trace.json') as fd:
+            trace = json.load(fd)
+
+        events = dict((event['name'], event) for event in trace['traceEvents'])
+        self.assertEqual(set(['directive', 'doctree-read', 'env-updated', 'doctree-resolved', 'visit', 'convert']),
+                         set(events))
+        self.assertEqual('X', events['convert']['ph'])
+        self.assertEqual({'docname': 'contents', 'uri': 'example.img'}, events['convert']['args'])
+        self.assertEqual({'docname': 'contents'}, events['doctree-resolved']['args'])
+        self.assertIn('tid', events['convert'])
+        self.assertIn('pid', events['convert'])
+        self.assertGreaterEqual(events['doctree-resolved']['dur'], events['visit']['dur'])
+
+        # tracer is released after build
+        self.assertIs(NULL_TRACER, get_tracer(app))
+
+    @with_app(buildername='html', create_new_srcdir=True, parallel=2)
+    def test_trace_file_on_parallel_build(self, app, status, warnings):
+        docnames = ['doc%d' % i for i in range(8)]
+        (app.srcdir / 'contents.rst').write_text('.. toctree::\n\n   ' + '\n   '.join(docnames))
+        for docname in docnames:
+            (app.srcdir / (docname + '.rst')).write_text('%s\n====\n\n.. image:: example.img\n' % docname)
+        (app.srcdir / 'example.img').write_text('')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        app.config.imagehelper_trace_file = 'trace.json'
+        on_builder_inited(app)
+        app.build()
+
+        with open(app.outdir / 'trace.json') as fd:
+            trace = json.load(fd)
+
+        # spans in parallel reading processes are merged into the trace
+        events = [event for event in trace['traceEvents'] if event['name'] == 'doctree-read']
+        self.assertEqual(set(['contents'] + docnames), set(event['args']['docname'] for event in events))
+        self.assertEqual(len(docnames) + 1, len(events))
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_trace_disabled(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('')
+        add_image_type(app, 'name', '.img', MyImageConverter)
+        on_builder_inited(app)
+        self.assertIs(NULL_TRACER, get_tracer(app))
+        app.build()
+
+        self.assertFalse((app.outdir / 'trace.json').exists())
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+from sphinx_testing import with_app
+from sphinxcontrib.imagehelper import add_image_type, ImageConverter
+from sphinxcontrib.imagehelper.imageext import on_builder_inited
+from sphinxcontrib.imagehelper.worker import ConverterWorker, WorkerError, get_worker_group, shutdown_workers
+
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+FAKE_WORKER = [sys.executable, os.path.join(os.path.dirname(__file__), 'fake_worker.py')]
+
+
+class WorkerImageConverter(ImageConverter):
+    worker_command = FAKE_WORKER
+
+    def get_filename_for(self, node):
+        return 'converted.png'
+
+
+class TestSphinxcontrib(unittest.TestCase):
+    def tearDown(self):
+        shutdown_workers()
+
+    @with_app(buildername='html', write_docstring=True, create_new_srcdir=True)
+    def test_converter_worker(self, app, status, warnings):
+        """
+        .. image:: example.img
+        """
+        (app.srcdir / 'example.img').write_text('image')
+        add_image_type(app, 'name', '.img', WorkerImageConverter)
+        app.config.imagehelper_keep_workers = True
+        on_builder_inited(app)
+
+        # first build: worker is started lazily
+        app.build()
+        with open(app.outdir / '_images' / 'converted.png') as fd:
+            self.assertEqual('image', fd.read())
+
+        group = get_worker_group(WorkerImageConverter(app))
+        self.assertEqual(1, len(group.workers))
+        process = group.workers[0].process
+        self.assertIsNone(process.poll())
+
+        # second build (image has changed): worker is reused
+        (app.srcdir / 'example.img').write_text('modified')
+        (app.srcdir / 'example.img').utime((time.time() + 1, time.time() + 1))
+        app.build()
+        with open(app.outdir / '_images' / 'converted.png') as fd:
+            self.assertEqual('modified', fd.read())
+        self.assertIs(process, group.workers[0].process)
+
+        # third build (shutdown workers at build-finished)
+        app.config.imagehelper_keep_workers = False
+        app.build()
+        self.assertIsNotNone(process.poll())
+
+    def test_worker_request(self):
+        worker = ConverterWorker(FAKE_WORKER)
+        try:
+            response = worker.request({'filename': __file__, 'to': os.devnull})
+            self.assertTrue(response['result'])
+
+            response = worker.request({'filename': 'unknown.img', 'to': os.devnull})
+            self.assertFalse(response['result'])
+            self.assertIn('unknown.img', response['error'])
+        finally:
+            worker.stop()
+
+        self.assertFalse(worker.is_alive())
+
+    def test_worker_exited(self):
+        worker = ConverterWorker([sys.executable, '-c', 'pass'])
+        with self.assertRaises(WorkerError):
+            worker.request({'filename': __file__, 'to': os.devnull})
+
+    def test_worker_timeout(self):
+        worker = ConverterWorker(FAKE_WORKER)
+        started = time.time()
+        with self.assertRaises(WorkerError) as context:
+            worker.request({'filename': __file__, 'to': os.devnull, 'sleep': 10}, timeout=0.5)
+        self.assertLess(time.time() - started, 5)
+        self.assertIn('timed out after 0.5 seconds', str(context.exception))
+        self.assertFalse(worker.is_alive())
+
+        # the worker is restarted on next request
+        response = worker.request({'filename': __file__, 'to': os.devnull}, timeout=5)
+        self.assertTrue(response['result'])
+        worker.stop()